@@ -0,0 +1,2 @@
+# the Django versions Janeway 1.3 runs on do not discover apps.py by themselves
+default_app_config = 'plugins.ezid.apps.EzidConfig'
@@ -4,4 +4,19 @@ from plugins.ezid.models import *
 class RepoEZIDSettingsAdmin(admin.ModelAdmin):
     pass
 
+class QueuedDepositAdmin(admin.ModelAdmin):
+    list_display = ('content_type', 'object_id', 'action', 'status', 'attempts', 'updated')
+    list_filter = ('status', 'action')
+
+class DepositRecordAdmin(admin.ModelAdmin):
+    list_display = ('content_type', 'object_id', 'action', 'doi', 'success', 'status', 'latency', 'created')
+    list_filter = ('success', 'status', 'action')
+
+class BulkRunAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'command', 'action', 'processed', 'succeeded', 'last_pk', 'finished', 'updated')
+    list_filter = ('command', 'finished')
+
 admin.site.register(RepoEZIDSettings, RepoEZIDSettingsAdmin)
+admin.site.register(QueuedDeposit, QueuedDepositAdmin)
+admin.site.register(DepositRecord, DepositRecordAdmin)
+admin.site.register(BulkRun, BulkRunAdmin)
@@ -0,0 +1,20 @@
+"""
+Django application configuration for the EZID plugin for Janeway
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+from django.apps import AppConfig
+
+
+class EzidConfig(AppConfig):
+    ''' connects the plugin's signal receivers once every model is loaded '''
+    name = 'plugins.ezid'
+    label = 'ezid'
+
+    def ready(self):
+        from plugins.ezid import signals
+        signals.connect()
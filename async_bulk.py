@@ -0,0 +1,263 @@
+"""
+asyncio deposit engine for the EZID plugin for Janeway
+
+Payloads are built and results recorded synchronously, one chunk of items at a time, so the ORM is never touched
+from the event loop. Only the EZID requests run on the loop, over a small keep-alive HTTP/1.1 client built on
+asyncio streams, bounded by a semaphore and paced by the same rate limiters, retries and circuit breakers as the
+threaded path.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import asyncio
+import base64
+import ssl
+import time
+from urllib.error import URLError
+from urllib.parse import urlsplit
+
+from django.db import close_old_connections
+from utils.logger import get_logger
+
+from plugins.ezid import logic, metrics, ratelimit, resilience
+from plugins.ezid.bulk import DEFAULT_WORKERS, DepositResult, compact, iterate
+from plugins.ezid.transport import EzidResponse, HTTP_TIMEOUT, MAX_IDLE_CONNECTIONS
+
+logger = get_logger(__name__)
+
+# items prepared, sent and recorded together, per worker
+CHUNK_PER_WORKER = 8
+
+
+class StaleConnection(Exception):
+    ''' a reused connection turned out to be closed before the request reached EZID '''
+
+
+class AsyncEzidClient:
+    ''' keep-alive HTTP/1.1 client for a single EZID endpoint, for use on one event loop '''
+    def __init__(self, endpoint_url):
+        parts = urlsplit(endpoint_url)
+        self.endpoint_url = endpoint_url
+        self.host = parts.hostname
+        self.netloc = parts.netloc
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.base_path = parts.path.rstrip('/')
+        self._idle = []
+
+    async def request(self, method, path, data, username, password, idempotent=False):
+        ''' sends a request to EZID and returns the EzidResponse, raising URLError on network failures '''
+        credentials = base64.b64encode(f"{username}:{password}".encode("UTF-8")).decode("ascii")
+        head = [f"{method} {self.base_path}/{path} HTTP/1.1",
+                f"Host: {self.netloc}",
+                "Connection: keep-alive",
+                "Content-Type: text/plain; charset=UTF-8",
+                f"Authorization: Basic {credentials}"]
+        body = data.encode("UTF-8") if data is not None else None
+        if body is not None:
+            head.append(f"Content-Length: {len(body)}")
+        message = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + (body or b"")
+
+        connection = self._acquire()
+        reused = connection is not None
+        try:
+            if not reused:
+                connection = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, ssl=self.ssl), HTTP_TIMEOUT)
+            status, text, will_close = await asyncio.wait_for(
+                self._exchange(connection, message, resend=reused, resend_unanswered=reused and idempotent), HTTP_TIMEOUT)
+        except StaleConnection:
+            # the server had dropped the idle keep-alive connection, start over on a fresh one
+            connection[1].close()
+            return await self.request(method, path, data, username, password, idempotent)
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError) as err:
+            # a timeout or a partial response, the request may have been acted on
+            if connection:
+                connection[1].close()
+            raise URLError(err)
+
+        if will_close or len(self._idle) >= MAX_IDLE_CONNECTIONS:
+            connection[1].close()
+        else:
+            self._idle.append(connection)
+
+        if not 200 <= status < 300 and not text.endswith("\n"):
+            # same as the error bodies returned by the threaded transport
+            text += "\n"
+        return EzidResponse(text, status)
+
+    def _acquire(self):
+        while self._idle:
+            connection = self._idle.pop()
+            reader, writer = connection
+            if not reader.at_eof() and not writer.is_closing():
+                return connection
+            writer.close()
+        return None
+
+    async def _exchange(self, connection, message, resend=False, resend_unanswered=False):
+        ''' sends message and reads the response, raising StaleConnection when it is safe to send it again
+
+        resend allows it when the message could not be written at all, resend_unanswered when the connection was
+        closed before a single byte of the response, which only idempotent requests can afford.
+        '''
+        reader, writer = connection
+        try:
+            writer.write(message)
+            await writer.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            if resend:
+                raise StaleConnection()
+            raise
+
+        status_line = await reader.readline()
+        if not status_line:
+            if resend_unanswered:
+                raise StaleConnection()
+            raise ConnectionResetError('EZID closed the connection without a response')
+        version, status = status_line.decode("latin-1").split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        will_close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self._read_chunked(reader)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            will_close = True
+        return int(status), body.decode("UTF-8"), will_close
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # skip any trailers up to the blank line ending the body
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+@metrics.timed('send_request')
+async def send_request_async(client, method, path, data, username, password):
+    ''' the coroutine version of logic.send_request, returning the same responses and "error: ..." strings '''
+    limiter = ratelimit.get_limiter(client.endpoint_url, username)
+    # minting on a shoulder creates a new identifier each time it is sent
+    idempotent = not path.startswith('shoulder/')
+    loop = asyncio.get_event_loop()
+
+    async def attempt():
+        if limiter:
+            # the limiters block, so they wait on a thread rather than holding up the loop
+            await loop.run_in_executor(None, limiter.acquire)
+        return await client.request(method, path, data, username, password, idempotent)
+
+    try:
+        return await resilience.call_async(attempt,
+                                           resilience.get_breaker(client.endpoint_url),
+                                           idempotent=idempotent)
+    except resilience.CircuitOpenError as e:
+        return f"error: {e}\n"
+    except Exception as e:
+        if not resilience.is_network_error(e):
+            raise
+        logger.error(f'EZID request to {client.endpoint_url}/{path} failed: {e}')
+        return f"error: {e}\n"
+
+async def _send_all(deposits, clients, semaphore):
+    async def send(deposit):
+        client = clients.get(deposit.endpoint_url)
+        if client is None:
+            client = clients[deposit.endpoint_url] = AsyncEzidClient(deposit.endpoint_url)
+        async with semaphore:
+            started = time.monotonic()
+            ezid_result = await send_request_async(client, deposit.method, deposit.path, deposit.payload,
+                                                   deposit.username, deposit.password)
+            return ezid_result, time.monotonic() - started
+    return await asyncio.gather(*(send(d) for d in deposits), return_exceptions=True)
+
+async def _semaphore(workers):
+    return asyncio.Semaphore(workers)
+
+def _prepare(prepare, item):
+    try:
+        return prepare(item)
+    except Exception as e:
+        logger.exception(f'EZID bulk deposit failed for {item}')
+        return True, False, str(e)
+
+def _complete(deposit, sent):
+    if isinstance(sent, Exception):
+        logger.error(f'EZID bulk deposit failed for {deposit.item}: {sent!r}')
+        return DepositResult(compact(deposit.item), True, False, str(sent))
+    ezid_result, latency = sent
+    try:
+        return DepositResult(compact(deposit.item), *logic.complete_deposit(deposit, ezid_result, latency=latency))
+    except Exception as e:
+        logger.exception(f'EZID bulk deposit failed for {deposit.item}')
+        return DepositResult(compact(deposit.item), True, False, str(e))
+
+def run_async_deposits(items, prepare, workers=DEFAULT_WORKERS, progress=None, chunk_size=None):
+    ''' sends the deposits prepare(item) returns for every item from a single event loop, yielding a DepositResult per item
+
+    prepare is logic.preprint_deposit or logic.journal_deposit with the action bound, and returns either a
+    logic.Deposit or the (enabled, success, msg) result when there is nothing to send. Items are handled in chunks:
+    the chunk's payloads are built, sent with at most `workers` requests in flight, then recorded with
+    logic.complete_deposit exactly as the threaded path records them. An optional Progress is updated with the pk
+    of each item.
+    '''
+    chunk_size = chunk_size or workers * CHUNK_PER_WORKER
+    loop = asyncio.new_event_loop()
+    # created on the loop, older Pythons bind asyncio primitives to the loop current at creation
+    semaphore = loop.run_until_complete(_semaphore(workers))
+    clients = {}
+    try:
+        chunk = []
+        for item in iterate(items):
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                yield from _run_chunk(chunk, prepare, loop, clients, semaphore, progress)
+                chunk = []
+        if chunk:
+            yield from _run_chunk(chunk, prepare, loop, clients, semaphore, progress)
+    finally:
+        loop.run_until_complete(asyncio.gather(*(c.close() for c in clients.values())))
+        loop.close()
+        close_old_connections()
+
+def _run_chunk(chunk, prepare, loop, clients, semaphore, progress):
+    deposits = []
+    for item in chunk:
+        if progress:
+            progress.submit(item.pk)
+        deposit = _prepare(prepare, item)
+        if isinstance(deposit, logic.Deposit):
+            deposits.append(deposit)
+        else:
+            yield _finished(DepositResult(compact(item), *deposit), progress)
+
+    sent = loop.run_until_complete(_send_all(deposits, clients, semaphore))
+    for deposit, outcome in zip(deposits, sent):
+        yield _finished(_complete(deposit, outcome), progress)
+
+def _finished(result, progress):
+    if progress:
+        progress.done(result.item.pk)
+    return result
+
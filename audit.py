@@ -0,0 +1,85 @@
+"""
+Audit log of the requests sent to EZID for the EZID plugin for Janeway
+
+Every completed deposit is stored as a DepositRecord. Single deposits are saved straight away; inside buffered(),
+as used by the bulk commands, records are collected and written with bulk_create instead.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import threading
+from contextlib import contextmanager
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from utils.logger import get_logger
+
+from plugins.ezid.models import DepositRecord
+
+logger = get_logger(__name__)
+
+# characters of each EZID response kept in the audit log
+RESPONSE_LIMIT = getattr(settings, 'EZID_AUDIT_RESPONSE_LIMIT', 1000)
+# records written by each bulk_create
+BATCH_SIZE = 100
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def build_record(deposit, ezid_result, doi, latency=None, spool_key=''):
+    ''' returns an unsaved DepositRecord for the outcome of sending a logic.Deposit, doi is None when it failed '''
+    success = doi is not None
+    if not doi and deposit.path and deposit.path.startswith('id/doi:'):
+        doi = unquote(deposit.path[len('id/doi:'):])
+    return DepositRecord(content_type=ContentType.objects.get_for_model(deposit.item),
+                         object_id=deposit.item.pk,
+                         action=deposit.action,
+                         doi=doi or '',
+                         success=success,
+                         status=getattr(ezid_result, 'status', None),
+                         latency=latency,
+                         digest=deposit.digest or '',
+                         response=str(ezid_result)[:RESPONSE_LIMIT],
+                         spool_key=spool_key)
+
+def record_deposit(deposit, ezid_result, doi, latency=None, spool_key=''):
+    ''' stores the outcome of sending a logic.Deposit, never letting a failure to do so fail the deposit '''
+    try:
+        record = build_record(deposit, ezid_result, doi, latency, spool_key)
+        with _buffer_lock:
+            if _buffer is not None:
+                _buffer.append(record)
+                if len(_buffer) < BATCH_SIZE:
+                    return
+                batch = _buffer[:]
+                del _buffer[:]
+            else:
+                batch = [record]
+        DepositRecord.objects.bulk_create(batch)
+    except Exception:
+        logger.exception(f'Could not record the EZID {deposit.action} of {deposit.item}')
+
+def flush():
+    with _buffer_lock:
+        if not _buffer:
+            return
+        batch = _buffer[:]
+        del _buffer[:]
+    DepositRecord.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+
+@contextmanager
+def buffered():
+    ''' collects the records of every deposit completed inside the block and writes them in batches '''
+    global _buffer
+    with _buffer_lock:
+        _buffer = []
+    try:
+        yield
+    finally:
+        flush()
+        with _buffer_lock:
+            _buffer = None
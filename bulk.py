@@ -0,0 +1,242 @@
+"""
+Bulk deposit helpers for the EZID plugin for Janeway
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import json
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.db.models import Model, Q, QuerySet
+from django.utils import timezone
+from utils.logger import get_logger
+
+from plugins.ezid import logic
+from plugins.ezid.models import BulkRun
+from repository.models import Preprint
+from submission.models import Article
+
+logger = get_logger(__name__)
+
+DEFAULT_WORKERS = 4
+# results between two saves of a bulk run's checkpoint
+CHECKPOINT_EVERY = 100
+# items loaded per query when walking a whole repository or journal
+CHUNK_SIZE = getattr(settings, 'EZID_CHUNK_SIZE', 500)
+
+DepositResult = namedtuple('DepositResult', ['item', 'enabled', 'success', 'msg'])
+
+
+class DepositItem:
+    ''' what a DepositResult keeps of a deposited preprint or article: its model, pk, DOI and display name
+
+    Results outlive their chunk of the selection, e.g. in a command's summary, so they hold one of these instead of the
+    model instance and its prefetch caches.
+    '''
+    __slots__ = ('model', 'pk', 'doi', 'label')
+
+    def __init__(self, item):
+        self.model = item._meta.label_lower
+        self.pk = item.pk
+        if hasattr(item, 'preprint_doi'):
+            self.doi = item.preprint_doi
+        elif hasattr(item, 'get_doi'):
+            self.doi = logic.get_article_doi(item)
+        else:
+            self.doi = None
+        self.label = str(item)
+
+    def __str__(self):
+        return self.label
+
+    def __repr__(self):
+        return f'<DepositItem {self.model} {self.pk}>'
+
+    def __eq__(self, other):
+        if isinstance(other, DepositItem):
+            return (self.model, self.pk) == (other.model, other.pk)
+        if isinstance(other, Model):
+            return (self.model, self.pk) == (other._meta.label_lower, other.pk)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.model, self.pk))
+
+
+def compact(item):
+    ''' the DepositItem for a model instance, anything else (e.g. a spool record) as it is '''
+    return DepositItem(item) if isinstance(item, Model) else item
+
+
+def select_preprints(short_name=None, from_id=None, to_id=None, published_after=None, published_before=None, missing_doi=False):
+    ''' returns the published preprints matching the given bulk selection, in pk order '''
+    preprints = Preprint.objects.filter(date_published__lt=timezone.now())
+    if short_name:
+        preprints = preprints.filter(repository__short_name=short_name)
+    if from_id is not None:
+        preprints = preprints.filter(pk__gte=from_id)
+    if to_id is not None:
+        preprints = preprints.filter(pk__lte=to_id)
+    if published_after:
+        preprints = preprints.filter(date_published__date__gte=published_after)
+    if published_before:
+        preprints = preprints.filter(date_published__date__lte=published_before)
+    if missing_doi:
+        preprints = preprints.filter(Q(preprint_doi__isnull=True) | Q(preprint_doi=''))
+    return logic.prefetch_preprint_metadata(preprints).order_by('pk')
+
+def select_articles(journal=None, issue=None, published_after=None, published_before=None, after_id=None):
+    ''' returns the articles matching the given batch selection in pk order, with the relations the deposit templates use prefetched '''
+    articles = Article.objects.all()
+    if journal:
+        articles = articles.filter(journal=journal)
+    if issue:
+        articles = articles.filter(Q(primary_issue=issue) | Q(issues=issue)).distinct()
+    if published_after:
+        articles = articles.filter(date_published__date__gte=published_after)
+    if published_before:
+        articles = articles.filter(date_published__date__lte=published_before)
+    if after_id is not None:
+        articles = articles.filter(pk__gt=after_id)
+    return logic.prefetch_journal_metadata(articles).order_by('pk')
+
+def in_chunks(items, size=CHUNK_SIZE):
+    ''' yields a pk ordered selection as lists of at most size items, each loaded by its own query after the last pk
+    of the one before, so a chunk (and whatever it prefetched) can be freed once the caller moves on '''
+    # the keyset only holds for pk order, whatever order the caller left on the selection
+    items = items.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = list((items if last_pk is None else items.filter(pk__gt=last_pk))[:size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+def iterate(items, size=CHUNK_SIZE):
+    ''' iterates a pk ordered queryset a chunk at a time, see in_chunks; any other iterable is iterated as it is '''
+    if not isinstance(items, QuerySet):
+        yield from items
+        return
+    for chunk in in_chunks(items, size):
+        yield from chunk
+
+class Progress:
+    ''' tracks the highest pk below which every item has been processed, so an interrupted run can be resumed from it '''
+    def __init__(self):
+        self.submitted = deque()
+        self.processed = set()
+        self.resume_after = None
+
+    def submit(self, pk):
+        self.submitted.append(pk)
+
+    def done(self, pk):
+        self.processed.add(pk)
+        while self.submitted and self.submitted[0] in self.processed:
+            self.resume_after = self.submitted.popleft()
+            self.processed.discard(self.resume_after)
+
+class Checkpoint:
+    ''' saves the progress of a BulkRun every `every` results, so the run can be resumed where it stopped '''
+    def __init__(self, run, every=CHECKPOINT_EVERY):
+        self.run = run
+        self.every = every
+        self.progress = Progress()
+        self.done_pks = set(json.loads(run.done_pks))
+        self.failures = set(json.loads(run.failures))
+        self.unsaved = 0
+
+    @classmethod
+    def start(cls, command, action, selection):
+        return cls(BulkRun.objects.create(command=command, action=action, selection=json.dumps(selection, cls=DjangoJSONEncoder)))
+
+    def remaining(self, items, retry_failed=False):
+        ''' filters a pk ordered selection down to the items this run has not processed yet, plus the ones it failed
+        on when retry_failed
+
+        The selection resumes after the highest pk done rather than last_pk, and the few items below it that were still
+        in flight are selected by pk, so the done pks are not excluded again in the query of every chunk.
+        '''
+        if self.run.last_pk is None and not self.done_pks:
+            return items
+        start = max(self.done_pks, default=self.run.last_pk)
+        in_flight = items.filter(pk__lte=start).exclude(pk__in=self.done_pks)
+        if self.run.last_pk is not None:
+            in_flight = in_flight.filter(pk__gt=self.run.last_pk)
+        pending = Q(pk__gt=start)
+        in_flight_pks = list(in_flight.prefetch_related(None).values_list('pk', flat=True))
+        if in_flight_pks:
+            pending |= Q(pk__in=in_flight_pks)
+        if retry_failed and self.failures:
+            pending |= Q(pk__in=self.failures)
+        return items.filter(pending)
+
+    def record(self, result):
+        pk = result.item.pk
+        self.run.processed += 1
+        if result.success:
+            self.run.succeeded += 1
+            self.failures.discard(pk)
+        elif result.enabled:
+            self.failures.add(pk)
+        self.unsaved += 1
+        if self.unsaved >= self.every:
+            self.save()
+
+    def save(self, finished=False):
+        if self.progress.resume_after is not None:
+            # failures retried on resume sit below last_pk, which must never move back to them
+            self.run.last_pk = max(self.progress.resume_after, self.run.last_pk or self.progress.resume_after)
+        self.done_pks = {pk for pk in self.done_pks | self.progress.processed
+                         if self.run.last_pk is None or pk > self.run.last_pk}
+        self.run.done_pks = json.dumps(sorted(self.done_pks))
+        self.run.failures = json.dumps(sorted(self.failures))
+        self.run.finished = finished
+        self.run.save()
+        self.unsaved = 0
+
+def _deposit(deposit, item):
+    try:
+        try:
+            enabled, success, msg = deposit(item)
+        except Exception as e:
+            logger.exception(f'EZID bulk deposit failed for {item}')
+            enabled, success, msg = True, False, str(e)
+        return DepositResult(compact(item), enabled, success, msg)
+    finally:
+        # each worker thread holds its own database connection
+        close_old_connections()
+
+def run_deposits(items, deposit, workers=DEFAULT_WORKERS, progress=None):
+    ''' calls deposit(item) for every item on a bounded thread pool and yields a DepositResult as each one finishes
+
+    Querysets are loaded a chunk at a time and at most 2 * workers items are in flight, so neither the selection nor
+    the results (which hold a DepositItem, not the instance) grow with the size of the run. An optional Progress is
+    updated with the pk of each item.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in iterate(items):
+            if progress:
+                progress.submit(item.pk)
+            pending.add(executor.submit(_deposit, deposit, item))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield _finished(future, progress)
+        for future in as_completed(pending):
+            yield _finished(future, progress)
+
+def _finished(future, progress):
+    result = future.result()
+    if progress:
+        progress.done(result.item.pk)
+    return result
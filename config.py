@@ -0,0 +1,96 @@
+"""
+Cached EZID configuration for journals and repositories
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import threading
+import time
+
+from django.conf import settings
+from utils import setting_handler
+
+from plugins.ezid import metrics
+from plugins.ezid.models import RepoEZIDSettings
+
+# seconds a snapshot is trusted for, settings saved in another process are only picked up after this
+CONFIG_TTL = getattr(settings, 'EZID_CONFIG_TTL', 300)
+
+
+class EZIDJournalConfig:
+    ''' snapshot of the plugin:ezid and Identifiers settings the EZID plugin needs for a journal '''
+    def __init__(self, journal):
+        self.journal_id = journal.pk
+        self.enabled = self._get('plugin:ezid', 'ezid_plugin_enable', journal)
+        self.username = self._get('plugin:ezid', 'ezid_plugin_username', journal)
+        self.password = self._get('plugin:ezid', 'ezid_plugin_password', journal)
+        self.endpoint_url = self._get('plugin:ezid', 'ezid_plugin_endpoint_url', journal)
+        self.book_chapter = self._get('plugin:ezid', 'ezid_book_chapter', journal)
+        self.depositor_name = self._get('Identifiers', 'crossref_name', journal)
+        self.depositor_email = self._get('Identifiers', 'crossref_email', journal)
+        self.registrant = self._get('Identifiers', 'crossref_registrant', journal)
+
+    @staticmethod
+    def _get(group, name, journal):
+        return setting_handler.get_setting(group, name, journal).processed_value
+
+    @property
+    def owner(self):
+        return self.registrant
+
+    @property
+    def template(self):
+        return 'ezid/book_chapter.xml' if self.book_chapter else 'ezid/journal_content.xml'
+
+    @property
+    def is_configured(self):
+        return bool(self.username and self.password and self.endpoint_url and self.owner)
+
+
+_journal_configs = {}
+_journal_configs_lock = threading.Lock()
+
+@metrics.timed('get_config')
+def get_journal_config(journal):
+    ''' returns the EZIDJournalConfig for journal, loading the settings at most once per CONFIG_TTL '''
+    now = time.monotonic()
+    with _journal_configs_lock:
+        cached = _journal_configs.get(journal.pk)
+    if cached and now - cached[0] < CONFIG_TTL:
+        return cached[1]
+
+    journal_config = EZIDJournalConfig(journal)
+    with _journal_configs_lock:
+        _journal_configs[journal.pk] = (now, journal_config)
+    return journal_config
+
+def clear_journal_configs(**kwargs):
+    ''' drops every cached journal snapshot, connected to SettingValue saves and deletes '''
+    with _journal_configs_lock:
+        _journal_configs.clear()
+
+
+_repo_configs = {}
+_repo_configs_lock = threading.Lock()
+
+@metrics.timed('get_config')
+def get_repo_config(repository):
+    ''' returns the RepoEZIDSettings for repository, or None if EZID is not enabled for it, querying at most once per CONFIG_TTL '''
+    now = time.monotonic()
+    with _repo_configs_lock:
+        cached = _repo_configs.get(repository.pk)
+    if cached and now - cached[0] < CONFIG_TTL:
+        return cached[1]
+
+    repo_config = RepoEZIDSettings.objects.filter(repo_id=repository.pk).first()
+    with _repo_configs_lock:
+        _repo_configs[repository.pk] = (now, repo_config)
+    return repo_config
+
+def clear_repo_configs(**kwargs):
+    ''' drops every cached repository configuration, connected to RepoEZIDSettings saves and deletes '''
+    with _repo_configs_lock:
+        _repo_configs.clear()
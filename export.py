@@ -0,0 +1,125 @@
+"""
+Streaming export of the Crossref XML deposited for a repository or journal, for the EZID plugin for Janeway
+
+The items are loaded a chunk at a time and each deposit is rendered and written as soon as it is ready, so memory use
+does not grow with the number of items. write_export writes one XML document with a deposit element per item wrapping
+the Crossref XML exactly as it is sent to EZID; write_batch writes a single Crossref doi_batch holding every deposit,
+which can be uploaded to Crossref as it is.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import re
+import time
+from urllib.parse import unquote
+from xml.sax.saxutils import escape, quoteattr
+
+from utils.logger import get_logger
+
+from plugins.ezid import bulk, logic, reconcile
+
+logger = get_logger(__name__)
+
+_RE_XML_DECLARATION = re.compile(r"^\s*<\?xml[^>]*\?>\s*")
+_RE_SCHEMA_VERSION = re.compile(r'xmlns="http://www\.crossref\.org/schema/([0-9.]+)"')
+_RE_BATCH_HEAD = re.compile(r"<head>.*?</head>", re.S)
+_RE_BATCH_BODY = re.compile(r"<body>(.*)</body>", re.S)
+_RE_BATCH_ID = re.compile(r"<doi_batch_id>.*?</doi_batch_id>", re.S)
+_RE_TIMESTAMP = re.compile(r"<timestamp>.*?</timestamp>", re.S)
+_RE_DOI_DATA = re.compile(r"(<doi_data>\s*<doi>).*?(</doi>\s*<resource>).*?(</resource>)", re.S)
+
+def render_deposits(items, prepare, chunk_size=bulk.CHUNK_SIZE):
+    ''' yields (item, deposit) for a pk ordered selection, deposit being a logic.Deposit or the result explaining why
+    there is none '''
+    for item in bulk.iterate(items, chunk_size):
+        try:
+            yield item, prepare(item)
+        except Exception as e:
+            logger.exception(f'EZID export failed for {item}')
+            yield item, (True, False, str(e))
+
+def deposit_doi(deposit):
+    ''' the DOI a deposit is for, empty for a mint '''
+    return unquote(deposit.path[len("id/doi:"):]) if deposit.path.startswith("id/doi:") else ""
+
+def deposit_element(deposit):
+    ''' the export element for one deposit, with its identifier and target as attributes '''
+    record = reconcile.parse_anvl(deposit.payload)
+    xml = _RE_XML_DECLARATION.sub("", record.get("crossref", "")).strip()
+    doi = deposit_doi(deposit)
+    return (f'<deposit model={quoteattr(deposit.item._meta.label_lower)} pk="{deposit.item.pk}" '
+            f'doi={quoteattr(doi)} target={quoteattr(record.get("_target", ""))}>\n{xml}\n</deposit>\n')
+
+def write_export(items, prepare, out, chunk_size=bulk.CHUNK_SIZE):
+    ''' writes the export document for items to the text stream out, a deposit at a time
+
+    prepare is logic.preprint_deposit or logic.journal_deposit with the action bound. Yields (item, result) for every
+    item, where result is None when the item was exported and the (enabled, success, msg) result otherwise.
+    '''
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<ezid_export>\n')
+    for item, deposit in render_deposits(items, prepare, chunk_size):
+        if isinstance(deposit, logic.Deposit):
+            out.write(deposit_element(deposit))
+            yield item, None
+        else:
+            yield item, deposit
+    out.write('</ezid_export>\n')
+
+def batch_head(batch_id, depositor_name, depositor_email, registrant):
+    ''' the head element of a Crossref doi_batch '''
+    return (f"<head><doi_batch_id>{escape(batch_id)}</doi_batch_id><timestamp>{int(time.time())}</timestamp>"
+            f"<depositor><depositor_name>{escape(depositor_name)}</depositor_name>"
+            f"<email_address>{escape(depositor_email)}</email_address></depositor>"
+            f"<registrant>{escape(registrant)}</registrant></head>")
+
+def batch_records(deposit):
+    ''' returns (version, head, records) for a deposit: the Crossref schema version of its XML, its head element when
+    it is a doi_batch itself, and the XML it adds to the body of a batch '''
+    record = reconcile.parse_anvl(deposit.payload)
+    xml = _RE_XML_DECLARATION.sub("", record.get("crossref", "")).strip()
+    match = _RE_SCHEMA_VERSION.search(xml)
+    version = match.group(1) if match else None
+    body = _RE_BATCH_BODY.search(xml)
+    if body is None:
+        # posted_content, which EZID wraps in a batch of its own after filling in the DOI and target of its doi_data
+        doi, target = escape(deposit_doi(deposit)), escape(record.get("_target", ""))
+        xml = _RE_DOI_DATA.sub(lambda m: f"{m.group(1)}{doi}{m.group(2)}{target}{m.group(3)}", xml, count=1)
+        return version, None, xml
+    head = _RE_BATCH_HEAD.search(xml)
+    return version, head.group(0) if head else None, body.group(1).strip()
+
+def write_batch(items, prepare, out, batch_id, head=None, chunk_size=bulk.CHUNK_SIZE):
+    ''' writes the deposits of items to the text stream out as one Crossref doi_batch, a deposit at a time
+
+    head is the head element of the batch, see batch_head. When it is None the head of the first deposit is used with
+    batch_id and the current time, which only works for the journal templates. A batch holds a single schema version,
+    so deposits of another version than the first are skipped. Nothing is written when there is nothing to export.
+    Yields (item, result) like write_export.
+    '''
+    batch_version = None
+    for item, deposit in render_deposits(items, prepare, chunk_size):
+        if not isinstance(deposit, logic.Deposit):
+            yield item, deposit
+            continue
+        version, deposit_head, records = batch_records(deposit)
+        if batch_version is None:
+            if head is None and deposit_head is None:
+                yield item, (True, False, "no head for the Crossref batch, give the depositor")
+                continue
+            if head is None:
+                head = _RE_TIMESTAMP.sub(f"<timestamp>{int(time.time())}</timestamp>",
+                                         _RE_BATCH_ID.sub(f"<doi_batch_id>{escape(batch_id)}</doi_batch_id>", deposit_head))
+            batch_version = version
+            out.write(f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                      f'<doi_batch xmlns="http://www.crossref.org/schema/{batch_version}" version="{batch_version}">\n'
+                      f'{head}\n<body>\n')
+        elif version != batch_version:
+            yield item, (True, False, f"a Crossref {version} deposit does not fit in a Crossref {batch_version} batch")
+            continue
+        out.write(records + "\n")
+        yield item, None
+    if batch_version is not None:
+        out.write('</body>\n</doi_batch>\n')
@@ -7,24 +7,41 @@ __author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
 __license__ = "BSD 3-Clause"
 __maintainer__ = "California Digital Library"
 
+import hashlib
 import re
+import time
+from collections import namedtuple
 from urllib.parse import quote
-import urllib.request as urlreq
 
 from django.core.validators import URLValidator, ValidationError
 from django.conf import settings
 from django.utils import timezone
-from django.template.loader import render_to_string
+from django.template.base import tag_re
+from django.template.loader import get_template
 from utils.logger import get_logger
 from utils import setting_handler
 from identifiers import logic as id_logic
 
 from django.contrib import messages
 
-from plugins.ezid.models import RepoEZIDSettings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Prefetch
+
+from plugins.ezid.models import QueuedDeposit, DepositDigest
+from repository.models import PreprintAuthor, PreprintVersion
+from submission.models import FrozenAuthor
+from identifiers.models import Identifier
+from plugins.ezid import audit, metrics, ratelimit, resilience, transport
+from plugins.ezid.config import get_journal_config, get_repo_config
 
 logger = get_logger(__name__)
 
+# compiled once, the validators run for every author and article of a bulk run
+_RE_ORCID = re.compile('https?://orcid.org/[0-9]{4}-[0-9]{4}-[0-9]{4}-[0-9]{3}[X0-9]{1}$')
+_RE_ISSN = re.compile("^[0-9]{4}-[0-9]{3}[0-9X]$")
+_validate_url = URLValidator()
+
 def get_valid_orcid(orcid):
     ''' Determine whether the given input_string is a valid ORCID '''
     if not orcid:
@@ -32,8 +49,7 @@ def get_valid_orcid(orcid):
     if not orcid.startswith('http'):
         orcid = f'https://orcid.org/{orcid}'
 
-    regex = re.compile('https?://orcid.org/[0-9]{4}-[0-9]{4}-[0-9]{4}-[0-9]{3}[X0-9]{1}$')
-    match = regex.match(str(orcid))
+    match = _RE_ORCID.match(str(orcid))
     return orcid if bool(match) else None
 
 
@@ -89,61 +105,95 @@ def is_valid_issn(issn):
     if not issn or issn == "0000-0000":
         return False
 
-    r = re.compile("^[0-9]{4}-[0-9]{3}[0-9X]$")
-
-    return re.search(r, issn)
+    return _RE_ISSN.search(issn)
 
 def is_valid_url(url):
     try:
-        validator = URLValidator()
-        validator(url)
+        _validate_url(url)
         return True
     except ValidationError:
         return False
 
-class EzidHTTPErrorProcessor(urlreq.HTTPErrorProcessor):
-    ''' Error Processor, required to let 201 responses pass '''
-    def http_response(self, request, response):
-        if response.code == 201:
-            my_return = response
-        else:
-            my_return = urlreq.HTTPErrorProcessor.http_response(self, request, response)
-        return my_return
-    https_response = http_response
-
+@metrics.timed('send_request')
 def send_request(method, path, data, username, password, endpoint_url):
-    ''' sends a request to EZID '''
-    request_url = f"{endpoint_url}/{path}"
-
-    opener = urlreq.build_opener(EzidHTTPErrorProcessor())
-    ezid_handler = urlreq.HTTPBasicAuthHandler()
-    ezid_handler.add_password("EZID", endpoint_url, username, password)
-    opener.add_handler(ezid_handler)
-
-    request = urlreq.Request(request_url)
-    request.get_method = lambda: method
-    request.add_header("Content-Type", "text/plain; charset=UTF-8")
-    request.data = data.encode("UTF-8")
+    ''' sends a request to EZID over the pooled keep-alive transport for endpoint_url
+
+    Every attempt waits for the account's rate limiter, if one is configured. Transient failures are retried with
+    backoff. Network errors, and calls made while EZID is failing consistently,
+    are returned as an EZID style "error: ..." response rather than raised, so they never escape an event hook.
+    '''
+    ezid_transport = transport.get_transport(endpoint_url)
+    limiter = ratelimit.get_limiter(endpoint_url, username)
+    # minting on a shoulder creates a new identifier each time it is sent
+    idempotent = not path.startswith('shoulder/')
+
+    def attempt():
+        if limiter:
+            limiter.acquire()
+        return ezid_transport.request(method, path, data, username, password, idempotent)
 
     try:
-        connection = opener.open(request)
-        response = connection.read()
-        return response.decode("UTF-8")
-
-    except urlreq.HTTPError as ezid_error:
-        if ezid_error.fp is not None:
-            response = ezid_error.fp.read().decode("utf-8")
-            if not response.endswith("\n"):
-                response += "\n"
-        return response
-
+        return resilience.call(attempt,
+                               resilience.get_breaker(endpoint_url),
+                               idempotent=idempotent)
+    except resilience.CircuitOpenError as e:
+        return f"error: {e}\n"
+    except Exception as e:
+        if not resilience.is_network_error(e):
+            raise
+        logger.error(f'EZID request to {endpoint_url}/{path} failed: {e}')
+        return f"error: {e}\n"
+
+_RE_COMBINE_WHITESPACE = re.compile(r"\s+")
+
+_payload_templates = {}
+
+def minify_template_source(source):
+    ''' collapses the whitespace in the literal text of a template, leaving the tags themselves untouched
+
+    Collapsing the text before rendering and collapsing the rendered output again gives the same result as only
+    collapsing the output, as long as the template has no tags that transform literal text (spaceless, filter, verbatim).
+    '''
+    parts = tag_re.split(source)
+    # split() puts the text between tags at the even indexes
+    parts[::2] = [_RE_COMBINE_WHITESPACE.sub(" ", text) for text in parts[::2]]
+    return "".join(parts)
+
+def get_payload_template(template):
+    ''' returns the compiled, minified version of template, compiling it on first use '''
+    compiled = _payload_templates.get(template)
+    if compiled is None:
+        original = get_template(template)
+        compiled = original.backend.from_string(minify_template_source(original.template.source))
+        _payload_templates[template] = compiled
+    return compiled
+
+@metrics.timed('prepare_payload')
 def prepare_payload(ezid_metadata, template, target_url, owner):
     # normalize xml output by collapsing all whitespace to a single space
-    _RE_COMBINE_WHITESPACE = re.compile(r"\s+")
-    metadata = _RE_COMBINE_WHITESPACE.sub(" ", render_to_string(template, ezid_metadata)).strip()
+    metadata = _RE_COMBINE_WHITESPACE.sub(" ", get_payload_template(template).render(ezid_metadata)).strip()
     payload = f"crossref: {metadata}\n_crossref: yes\n_profile: crossref\n_target: {target_url}\n_owner: {owner}"
     return payload
 
+# elements that change on every render without the metadata changing
+_RE_VOLATILE_ELEMENTS = re.compile(r"<(timestamp|doi_batch_id|posted_date)>.*?</\1>")
+
+def payload_digest(payload):
+    ''' sha256 of a prepare_payload result, ignoring the elements derived from the time of rendering '''
+    return hashlib.sha256(_RE_VOLATILE_ELEMENTS.sub("", payload).encode("UTF-8")).hexdigest()
+
+def is_unchanged(item, digest):
+    ''' True when digest matches the last payload successfully deposited for item '''
+    return DepositDigest.objects.filter(content_type=ContentType.objects.get_for_model(item),
+                                        object_id=item.pk,
+                                        digest=digest).exists()
+
+def record_digest(item, digest):
+    DepositDigest.objects.update_or_create(content_type=ContentType.objects.get_for_model(item),
+                                           object_id=item.pk,
+                                           defaults={'digest': digest})
+
+@metrics.timed('process_ezid_result')
 def process_ezid_result(item, action, ezid_result, request):
     if isinstance(ezid_result, str):
         if ezid_result.startswith('success:'):
@@ -163,18 +213,57 @@ def process_ezid_result(item, action, ezid_result, request):
 
     return None
 
+Deposit = namedtuple('Deposit', ['item', 'action', 'method', 'path', 'payload', 'digest', 'username', 'password', 'endpoint_url'])
+
+def complete_deposit(deposit, ezid_result, request=None, latency=None, spool_key=''):
+    ''' records the outcome of sending a Deposit to EZID and returns the (enabled, success, msg) result '''
+    doi = process_ezid_result(deposit.item, deposit.action, ezid_result, request)
+    if doi:
+        if deposit.action == "mint":
+            # only preprints are minted, articles are registered with the DOI they already have
+            deposit.item.preprint_doi = doi
+            deposit.item.save()
+        record_digest(deposit.item, deposit.digest)
+    audit.record_deposit(deposit, ezid_result, doi, latency, spool_key)
+    metrics.increment(metrics.DEPOSITS_TOTAL, action=deposit.action, outcome='success' if doi else 'failure')
+    return True, (doi != None), ezid_result
+
+def send_deposit(deposit, request=None):
+    started = time.monotonic()
+    ezid_result = send_request(deposit.method, deposit.path, deposit.payload, deposit.username, deposit.password, deposit.endpoint_url)
+    return complete_deposit(deposit, ezid_result, request, latency=time.monotonic() - started)
+
+def prefetch_preprint_metadata(preprints):
+    ''' adds the joins and prefetches get_preprint_metadata needs to a Preprint queryset, so that building the
+    metadata for every preprint in it takes the same number of queries however many preprints there are '''
+    return preprints.select_related('repository__press', 'license').prefetch_related(
+        'subject',
+        Prefetch('preprintauthor_set', queryset=PreprintAuthor.objects.select_related('account')),
+        Prefetch('preprintversion_set', queryset=PreprintVersion.objects.select_related('file').order_by('-version', '-pk'), to_attr='ezid_versions'),
+    )
+
+def get_current_version(preprint):
+    ''' the current version of preprint, taken from prefetch_preprint_metadata's prefetch when present '''
+    versions = getattr(preprint, 'ezid_versions', None)
+    if versions is None:
+        return preprint.current_version
+    return versions[0] if versions else None
+
+@metrics.timed('get_metadata')
 def get_preprint_metadata(preprint):
+    current_version = get_current_version(preprint)
     ezid_metadata = {'now': timezone.now(),
                      'target_url': preprint.url,
-                     'group_title': preprint.subject.values_list()[0][2],
+                     'group_title': preprint.subject.all()[0].name,
                      'contributors': normalize_author_metadata(preprint.preprintauthor_set.all()),
                      'title': escape_str(preprint.title),
                      'published_date': get_date_dict(preprint.date_published),
-                     'accepted_date': get_date_dict(preprint.date_accepted),
+                     # posted_content.xml falls back to the day of rendering, which would change the payload every day
+                     'accepted_date': get_date_dict(preprint.date_accepted or preprint.date_published or preprint.date_submitted),
                      'abstract': escape_str(preprint.abstract),
                      'license_url': get_license_url(preprint),
                      'site_url': preprint.repository.site_url,
-                     'download_url': preprint.current_version.file.download_url if preprint.current_version.file else None}
+                     'download_url': current_version.file.download_url if current_version and current_version.file else None}
 
     if preprint.doi:
         if is_valid_url(preprint.doi):
@@ -184,10 +273,23 @@ def get_preprint_metadata(preprint):
 
     return ezid_metadata
 
-def preprint_doi(preprint, action, request):
-    if RepoEZIDSettings.objects.filter(repo=preprint.repository).exists():
+def preprint_deposit(preprint, action, request=None, force=False):
+    ''' prepares the EZID request for minting or updating a preprint's DOI
+
+    Returns a Deposit ready to send, or the (enabled, success, msg) result when there is nothing to send.
+    '''
+    if action == "update" and not preprint.preprint_doi:
+        msg = f'{preprint} does not have a DOI'
+        logger.info(msg)
+        return True, False, msg
+    if action == "mint" and preprint.preprint_doi:
+        msg = f'{preprint} already has a DOI: {preprint.preprint_doi}'
+        logger.info(msg)
+        return True, False, msg
+
+    ezid_settings = get_repo_config(preprint.repository)
+    if ezid_settings:
         ezid_metadata = get_preprint_metadata(preprint)
-        ezid_settings = RepoEZIDSettings.objects.get(repo=preprint.repository)
 
         shoulder = ezid_settings.ezid_shoulder
         username = ezid_settings.ezid_username
@@ -196,48 +298,79 @@ def preprint_doi(preprint, action, request):
         owner = ezid_settings.ezid_owner
 
         payload = prepare_payload(ezid_metadata, 'ezid/posted_content.xml', ezid_metadata['target_url'], owner)
+        digest = payload_digest(payload)
 
         if action == "update":
+            if not force and is_unchanged(preprint, digest):
+                msg = f'{preprint} unchanged since the last EZID deposit, skipped'
+                logger.info(msg)
+                return True, True, msg
             path = f'id/doi:{encode(preprint.preprint_doi)}'
         else:
             path = f'shoulder/{encode(shoulder)}'
 
-        ezid_result = send_request("POST", path, payload, username, password, endpoint_url)
-        doi = process_ezid_result(preprint, action, ezid_result, request)
-        if doi:
-            preprint.preprint_doi = doi
-            preprint.save()
-        return True, (doi != None), ezid_result
+        return Deposit(preprint, action, "POST", path, payload, digest, username, password, endpoint_url)
     else:
         return False, False, f"EZID not enabled for {preprint.repository}"
 
-def update_preprint_doi(preprint, request=None):
-    if not preprint.preprint_doi:
-        msg = f'{preprint} does not have a DOI'
-        logger.info(msg)
-        return True, False, msg
-    else:
-        return preprint_doi(preprint, "update", request)
+def preprint_doi(preprint, action, request, force=False):
+    deposit = preprint_deposit(preprint, action, request, force=force)
+    if not isinstance(deposit, Deposit):
+        return deposit
+    return send_deposit(deposit, request)
+
+def update_preprint_doi(preprint, request=None, force=False):
+    return preprint_doi(preprint, "update", request, force=force)
 
 def mint_preprint_doi(preprint, request=None):
-    if preprint.preprint_doi:
-        msg = f'{preprint} already has a DOI: {preprint.preprint_doi}'
-        logger.info(msg)
-        return True, False, msg
-    else:
-        return preprint_doi(preprint, "mint", request)
+    return preprint_doi(preprint, "mint", request)
 
 def preprint_publication(**kwargs):
     ''' hook script for the preprint_publication event '''
     logger.debug('>>> preprint_publication called, mint an EZID DOI...')
     preprint = kwargs.get('preprint')
     request = kwargs.get('request')
-    enabled, success, msg = mint_preprint_doi(preprint, request=request)
+    if getattr(settings, 'EZID_QUEUE_DEPOSITS', True):
+        enqueue_deposit(preprint, "mint", request=request)
+    else:
+        enabled, success, msg = mint_preprint_doi(preprint, request=request)
 
 def get_setting(name, journal):
     return setting_handler.get_setting('plugin:ezid', name, journal).processed_value
 
-def get_journal_metadata(article):
+FrozenAuthorRecord = namedtuple('FrozenAuthorRecord', ['order', 'is_corporate', 'institution', 'given_names', 'last_name', 'orcid'])
+IssueRecord = namedtuple('IssueRecord', ['date', 'volume', 'issue'])
+
+def prefetch_journal_metadata(articles):
+    ''' adds the joins and prefetches get_journal_metadata needs to an Article queryset, so that building the
+    metadata for every article in it takes the same number of queries however many articles there are '''
+    return articles.select_related('journal', 'primary_issue', 'license').prefetch_related(
+        Prefetch('frozenauthor_set', queryset=FrozenAuthor.objects.select_related('author'), to_attr='ezid_authors'),
+        Prefetch('identifier_set', queryset=Identifier.objects.filter(id_type='doi').order_by('pk'), to_attr='ezid_dois'),
+    )
+
+def get_article_doi(article):
+    ''' the DOI of article, taken from prefetch_journal_metadata's prefetch when present '''
+    dois = getattr(article, 'ezid_dois', None)
+    if dois is None:
+        return article.get_doi()
+    return dois[0].identifier if dois else None
+
+def get_frozen_authors(article):
+    ''' the frozen authors of article as plain records, taken from prefetch_journal_metadata's prefetch when present '''
+    authors = getattr(article, 'ezid_authors', None)
+    if authors is None:
+        authors = article.frozenauthor_set.select_related('author')
+    return [FrozenAuthorRecord(a.order, a.is_corporate, a.institution, a.given_names, a.last_name, a.orcid) for a in authors]
+
+def get_issue_record(article):
+    issue = article.issue
+    return IssueRecord(issue.date, issue.volume, issue.issue) if issue else None
+
+@metrics.timed('get_metadata')
+def get_journal_metadata(article, journal_config=None):
+    ''' returns the template context for an article deposit, with every value the templates use already resolved '''
+    journal_config = journal_config or get_journal_config(article.journal)
     download_url = None
     if article.remote_url:
         # get id from url and add prefix to prepare item id
@@ -246,32 +379,45 @@ def get_journal_metadata(article):
         download_url = f'https://escholarship.org/content/{itemId}/{itemId}.pdf'
     return {'now': timezone.now(),
             'target_url': article.remote_url,
-            'article': article,
+            'article_pk': article.pk,
+            'article_title': article.title,
+            'article_abstract': article.abstract,
+            'journal_name': article.journal.name,
+            'journal_issn': article.journal.issn,
+            'issue': get_issue_record(article),
+            'date_published': article.date_published,
+            'authors': get_frozen_authors(article),
             'title': escape_str(article.title),
             'abstract': escape_str(article.abstract),
-            'doi': article.get_doi(),
-            'depositor_name': setting_handler.get_setting('Identifiers', 'crossref_name', article.journal).processed_value,
-            'depositor_email': setting_handler.get_setting('Identifiers', 'crossref_email', article.journal).processed_value,
-            'registrant': setting_handler.get_setting('Identifiers', 'crossref_registrant', article.journal).processed_value,
+            'doi': get_article_doi(article),
+            'depositor_name': journal_config.depositor_name,
+            'depositor_email': journal_config.depositor_email,
+            'registrant': journal_config.registrant,
             'download_url': download_url,
             'license_url': get_license_url(article)}
 
 def get_journal_template(journal):
-    return 'ezid/book_chapter.xml' if get_setting('ezid_book_chapter', journal) else 'ezid/journal_content.xml'
-
-def journal_article_doi(article, action, request):
-    if get_setting('ezid_plugin_enable', article.journal):
-        if not is_valid_issn(article.journal.issn) and not is_valid_url(article.journal.issn):
-            msg = f"Invalid ISSN {article.journal.issn} for {article.journal}"
+    return get_journal_config(journal).template
+
+def journal_deposit(article, action, request=None, force=False):
+    ''' prepares the EZID request for registering or updating an article's DOI
+
+    Returns a Deposit ready to send, or the (enabled, success, msg) result when there is nothing to send.
+    '''
+    journal_config = get_journal_config(article.journal)
+    if journal_config.enabled:
+        issn = article.journal.issn
+        if not is_valid_issn(issn) and not is_valid_url(issn):
+            msg = f"Invalid ISSN {issn} for {article.journal}"
             if request: messages.error(request, msg)
             return True, False, msg
 
-        ezid_metadata = get_journal_metadata(article)
+        ezid_metadata = get_journal_metadata(article, journal_config)
         if not ezid_metadata["doi"] and action != "mint":
             msg = f"{article} not assigned a DOI"
             if request: messages.error(request, msg)
             return True, False, msg
-        template = get_journal_template(article.journal)
+        template = journal_config.template
 
         if action == "update":
             ezid_metadata['update_id'] = ezid_metadata["doi"]
@@ -279,34 +425,97 @@ def journal_article_doi(article, action, request):
         else:
             method = "PUT"
 
-        username = get_setting('ezid_plugin_username', article.journal)
-        password = get_setting('ezid_plugin_password', article.journal)
-        endpoint_url = get_setting('ezid_plugin_endpoint_url', article.journal)
-        owner = setting_handler.get_setting('Identifiers', 'crossref_registrant', article.journal).processed_value
+        username = journal_config.username
+        password = journal_config.password
+        endpoint_url = journal_config.endpoint_url
+        owner = journal_config.owner
 
-        if not username or not password or not endpoint_url or not owner:
+        if not journal_config.is_configured:
             msg = f"EZID not fully configured for {article.journal}"
             if request: messages.error(request, msg)
             return True, False, msg
 
         path = f'id/doi:{encode(ezid_metadata["doi"])}'
         payload = prepare_payload(ezid_metadata, template, ezid_metadata["target_url"], owner)
-        ezid_result = send_request(method, path, payload, username, password, endpoint_url)
-        doi = process_ezid_result(article, action, ezid_result, request)
-        return True, (doi != None), ezid_result
+        digest = payload_digest(payload)
+        if action == "update" and not force and is_unchanged(article, digest):
+            msg = f'{article} unchanged since the last EZID deposit, skipped'
+            logger.info(msg)
+            return True, True, msg
+
+        return Deposit(article, action, method, path, payload, digest, username, password, endpoint_url)
     else:
         msg = f"EZID not enabled for {article.journal}"
         if request: messages.warning(request, msg)
         return False, False, msg
 
-def update_journal_doi(article, request=None):
-    return journal_article_doi(article, "update", request)
+def journal_article_doi(article, action, request, force=False):
+    deposit = journal_deposit(article, action, request, force=force)
+    if not isinstance(deposit, Deposit):
+        return deposit
+    return send_deposit(deposit, request)
+
+def update_journal_doi(article, request=None, force=False):
+    return journal_article_doi(article, "update", request, force=force)
 
 def register_journal_doi(article, request=None):
     return journal_article_doi(article, "register", request)
 
 def assign_article_doi(**kwargs):
     article = kwargs.get('article')
-    if get_setting('ezid_plugin_enable', article.journal):
+    if get_journal_config(article.journal).enabled:
         if not article.get_doi():
             id = id_logic.generate_crossref_doi_with_pattern(article)
+
+def enqueue_deposit(item, action, request=None):
+    ''' queues a deposit of item for the process_ezid_queue command rather than calling EZID during the request '''
+    queued, created = QueuedDeposit.objects.get_or_create(content_type=ContentType.objects.get_for_model(item),
+                                                          object_id=item.pk,
+                                                          action=action,
+                                                          status=QueuedDeposit.PENDING)
+    msg = f'EZID DOI {action} queued for {item}'
+    logger.debug(msg)
+    if request: messages.info(request, msg)
+    return queued
+
+QUEUE_ACTIONS = {
+    ('repository', 'preprint', 'mint'): mint_preprint_doi,
+    ('repository', 'preprint', 'update'): update_preprint_doi,
+    ('submission', 'article', 'register'): register_journal_doi,
+    ('submission', 'article', 'update'): update_journal_doi,
+}
+
+def claim_queued_deposits(limit):
+    ''' marks up to limit pending deposits as running and returns them, safe to call from several workers at once '''
+    with transaction.atomic():
+        queued = list(QueuedDeposit.objects.select_for_update(skip_locked=True)
+                                           .filter(status=QueuedDeposit.PENDING)
+                                           .order_by('created')[:limit])
+        QueuedDeposit.objects.filter(pk__in=[q.pk for q in queued]).update(status=QueuedDeposit.RUNNING, updated=timezone.now())
+    return queued
+
+def requeue_stale_deposits(older_than):
+    ''' returns running deposits not updated since older_than to the queue, e.g. after a worker was killed '''
+    return QueuedDeposit.objects.filter(status=QueuedDeposit.RUNNING, updated__lt=older_than).update(status=QueuedDeposit.PENDING)
+
+def process_queued_deposit(queued):
+    ''' sends a claimed deposit to EZID and records the outcome on the queue row '''
+    key = (queued.content_type.app_label, queued.content_type.model, queued.action)
+    deposit = QUEUE_ACTIONS.get(key)
+    item = queued.item
+    if deposit is None or item is None:
+        enabled, success, msg = False, False, f'Cannot {queued.action} {queued.content_type.model} {queued.object_id}'
+    else:
+        try:
+            enabled, success, msg = deposit(item)
+        except Exception as e:
+            logger.exception(f'EZID DOI {queued.action} failed for {item}')
+            enabled, success, msg = True, False, str(e)
+
+    queued.attempts += 1
+    queued.enabled = enabled
+    queued.success = success
+    queued.result = str(msg)
+    queued.status = QueuedDeposit.DONE if success or not enabled else QueuedDeposit.FAILED
+    queued.save()
+    return enabled, success, msg
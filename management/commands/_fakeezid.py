@@ -0,0 +1,106 @@
+"""
+Local stand-in for the EZID API, for benchmarks and tests of the EZID plugin for Janeway
+
+Mints on a shoulder answer 201 with a new DOI, creates (PUT) answer 201 and updates (POST) 200. Responses can be
+delayed, a share of them failed with 503 or rejected with 400, and requests without the expected Basic credentials
+challenged with 401.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import base64
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+class FakeEzidServer:
+    def __init__(self, latency=0, error_rate=0, reject_rate=0, challenge=False, username="username", password="password", seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.challenge = challenge
+        self.credentials = "Basic " + base64.b64encode(f"{username}:{password}".encode("UTF-8")).decode("ascii")
+        self.statuses = Counter()
+        self._random = random.Random(seed)
+        self._minted = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def respond(self, method, path, authorization):
+        ''' returns the (status, body) EZID would answer the request with '''
+        if self.challenge and authorization != self.credentials:
+            return 401, "error: unauthorized"
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            roll = self._random.random()
+            minted = next(self._minted)
+        if roll < self.error_rate:
+            return 503, "error: service unavailable"
+        if roll < self.error_rate + self.reject_rate:
+            return 400, "error: bad request - element 'crossref': invalid metadata"
+
+        if path.startswith("/shoulder/"):
+            shoulder = unquote(path[len("/shoulder/"):]).replace("doi:", "")
+            return 201, f"success: doi:{shoulder}FAKE{minted} | ark:/b5072/fake{minted}"
+        if path.startswith("/id/doi:"):
+            doi = unquote(path[len("/id/doi:"):])
+            return (201 if method == "PUT" else 200), f"success: doi:{doi}"
+        return 400, "error: bad request - unrecognized path"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                status, text = server.respond(self.command, self.path, self.headers.get("Authorization"))
+                with server._lock:
+                    server.statuses[status] += 1
+                body = text.encode("UTF-8")
+                self.send_response(status)
+                if status == 401:
+                    self.send_header("WWW-Authenticate", 'Basic realm="EZID"')
+                self.send_header("Content-Type", "text/plain; charset=UTF-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,26 @@
+"""
+Janeway Management command that records the results of deposit_ezid_spool in the database
+"""
+
+from django.core.management.base import BaseCommand
+from plugins.ezid import audit, spool
+
+class Command(BaseCommand):
+    """ Saves minted DOIs, deposit digests and audit records for the requests in a results file written by deposit_ezid_spool """
+    help = "Records the successful deposits in an EZID spool results file."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "results", help="path of the JSONL results file written by deposit_ezid_spool", type=str)
+
+    def handle(self, *args, **options):
+        applied = 0
+        with open(options['results'], encoding='UTF-8') as results_file, audit.buffered():
+            for result in spool.apply_results(results_file):
+                if not result.enabled:
+                    self.stdout.write(self.style.WARNING(f'{result.item}: {result.msg}'))
+                elif not result.success:
+                    self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+                else:
+                    applied += 1
+        self.stdout.write(self.style.SUCCESS(f"✅ {applied} deposits recorded from {options['results']}"))
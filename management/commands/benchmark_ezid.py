@@ -0,0 +1,236 @@
+"""
+Janeway Management command that benchmarks the EZID deposit paths against a local fake EZID server
+
+A development tool: it sets up a throwaway test database with synthetic preprints and articles, using Janeway's test
+helpers, so it lives here, imported only when the command is run, rather than in the plugin's runtime modules. Every
+path updates the DOIs of the same items with force=True, so all of them send one request per item.
+"""
+
+import json
+import platform
+import threading
+import time
+from datetime import timedelta
+from functools import partial
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.runner import DiscoverRunner
+from django.utils import timezone
+from utils import setting_handler
+from utils.testing import helpers
+
+from plugins.ezid import async_bulk, audit, bulk, logic, resilience, transport
+from plugins.ezid.management.commands._fakeezid import FakeEzidServer
+from plugins.ezid.models import DepositRecord, RepoEZIDSettings
+from plugins.ezid.plugin_settings import VERSION
+from identifiers.models import Identifier
+
+PATHS = ['single', 'threaded', 'async']
+KINDS = ['preprints', 'articles']
+
+SHOULDER = 'doi:10.5072/FK2'
+
+
+class QueryCounter:
+    ''' counts the queries run on every database connection, including those opened by worker threads, while active '''
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            self._connections.append(connection)
+
+    def __enter__(self):
+        connection_created.connect(self._install)
+        for connection in connections.all():
+            self._install(None, connection)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self._install)
+        for connection in self._connections:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+        self._connections = []
+
+
+def percentile(values, fraction):
+    ''' nearest rank percentile of values, None when there are none '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def create_preprints(press, count, endpoint_url, username, password):
+    user = helpers.create_user("ezid-benchmark@test.edu", first_name="Bench", last_name="Mark")
+    repo, subject = helpers.create_repository(press, [user], [user])
+    RepoEZIDSettings.objects.create(repo=repo,
+                                    ezid_shoulder=SHOULDER,
+                                    ezid_owner="owner",
+                                    ezid_username=username,
+                                    ezid_password=password,
+                                    ezid_endpoint_url=endpoint_url)
+    published = timezone.now() - timedelta(days=1)
+    for i in range(count):
+        preprint = helpers.create_preprint(repo, user, subject)
+        preprint.preprint_doi = f"10.5072/FK2BENCH{i}"
+        preprint.date_published = published
+        preprint.save()
+    return bulk.select_preprints(short_name=repo.short_name)
+
+def create_articles(count, endpoint_url, username, password):
+    journal, _ = helpers.create_journals()
+    for group, name, value in [('Identifiers', 'crossref_name', "EZID benchmark"),
+                               ('Identifiers', 'crossref_email', "ezid-benchmark@test.edu"),
+                               ('Identifiers', 'crossref_registrant', "registrant"),
+                               ('plugin:ezid', 'ezid_plugin_enable', True),
+                               ('plugin:ezid', 'ezid_plugin_endpoint_url', endpoint_url),
+                               ('plugin:ezid', 'ezid_plugin_username', username),
+                               ('plugin:ezid', 'ezid_plugin_password', password)]:
+        setting_handler.save_setting(group, name, journal, value)
+    for i in range(count):
+        article = helpers.create_article(journal, remote_url=f"https://test.org/bench{i}")
+        Identifier.objects.create(id_type="doi", identifier=f"10.5072/FK2ART{i}", article=article)
+    return bulk.select_articles(journal=journal)
+
+def run_path(path, kind, items, workers):
+    ''' updates every item through one deposit path and returns the (enabled, success, msg) results '''
+    # a fresh queryset, so no path reuses the instances another one loaded
+    items = items.all()
+    if kind == 'preprints':
+        deposit = partial(logic.update_preprint_doi, force=True)
+        prepare = partial(logic.preprint_deposit, action="update", force=True)
+    else:
+        deposit = partial(logic.update_journal_doi, force=True)
+        prepare = partial(logic.journal_deposit, action="update", force=True)
+
+    if path == 'single':
+        return [deposit(item) for item in items]
+    if path == 'threaded':
+        return [r[1:] for r in bulk.run_deposits(items, deposit, workers=workers)]
+    return [r[1:] for r in async_bulk.run_async_deposits(items, prepare, workers=workers)]
+
+def benchmark(path, kind, items, workers):
+    ''' times one deposit path over items and returns its figures '''
+    transport.close_transports()
+    resilience.reset_breakers()
+    content_type = ContentType.objects.get_for_model(items.model)
+    since = DepositRecord.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    count = items.count()
+
+    started = time.perf_counter()
+    with QueryCounter() as queries, audit.buffered():
+        results = run_path(path, kind, items, workers)
+    seconds = time.perf_counter() - started
+
+    latencies = list(DepositRecord.objects.filter(pk__gt=since, content_type=content_type)
+                                          .exclude(latency=None)
+                                          .values_list('latency', flat=True))
+    succeeded = sum(1 for enabled, success, msg in results if success)
+    return {
+        'path': path,
+        'kind': kind,
+        'workers': workers if path != 'single' else 1,
+        'items': count,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'seconds': round(seconds, 3),
+        'items_per_second': round(count / seconds, 2) if seconds else None,
+        'latency_p50_ms': _ms(percentile(latencies, 0.5)),
+        'latency_p99_ms': _ms(percentile(latencies, 0.99)),
+        'queries': queries.count,
+        'queries_per_item': round(queries.count / count, 2) if count else None,
+    }
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+class Command(BaseCommand):
+    """ Deposits synthetic preprints and articles through each deposit path in a throwaway test database and reports the throughput as JSON """
+    help = "Benchmarks the EZID deposit paths against a local fake EZID server and prints the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--items", help="number of synthetic preprints and of synthetic articles", type=int, default=200)
+        parser.add_argument(
+            "--workers", help="number of concurrent EZID requests for the threaded and async paths", type=int, default=8)
+        parser.add_argument(
+            "--paths", help="comma separated deposit paths to run", type=str, default=",".join(PATHS))
+        parser.add_argument(
+            "--kinds", help="comma separated kinds of items to deposit", type=str, default=",".join(KINDS))
+        parser.add_argument(
+            "--latency", help="seconds the fake EZID server waits before each response", type=float, default=0.05)
+        parser.add_argument(
+            "--error-rate", help="share of requests the fake EZID server fails with 503", type=float, default=0)
+        parser.add_argument(
+            "--reject-rate", help="share of requests the fake EZID server rejects with 400", type=float, default=0)
+        parser.add_argument(
+            "--challenge", help="make the fake EZID server answer 401 to requests without the expected credentials", action="store_true")
+        parser.add_argument(
+            "--output", help="file to write the JSON results to instead of stdout", type=str)
+
+    def handle(self, *args, **options):
+        paths = options['paths'].split(',')
+        kinds = options['kinds'].split(',')
+        if not set(paths) <= set(PATHS) or not set(kinds) <= set(KINDS):
+            raise CommandError(f"--paths must be taken from {', '.join(PATHS)} and --kinds from {', '.join(KINDS)}.")
+        if options['items'] < 1 or options['workers'] < 1:
+            raise CommandError('--items and --workers must be at least 1.')
+
+        server = FakeEzidServer(latency=options['latency'],
+                                error_rate=options['error_rate'],
+                                reject_rate=options['reject_rate'],
+                                challenge=options['challenge'],
+                                seed=0)
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        self.stderr.write("Setting up a test database for the benchmark")
+        old_config = runner.setup_databases()
+        try:
+            with server:
+                call_command('install_plugins', 'ezid', verbosity=0)
+                press = helpers.create_press()
+                selections = {}
+                if 'preprints' in kinds:
+                    selections['preprints'] = create_preprints(press, options['items'], server.url, "username", "password")
+                if 'articles' in kinds:
+                    selections['articles'] = create_articles(options['items'], server.url, "username", "password")
+
+                results = []
+                for kind in kinds:
+                    for path in paths:
+                        self.stderr.write(f"Depositing {options['items']} {kind} through the {path} path")
+                        results.append(benchmark(path, kind, selections[kind], options['workers']))
+                statuses = dict(server.statuses)
+        finally:
+            runner.teardown_databases(old_config)
+
+        report = json.dumps({
+            'plugin_version': VERSION,
+            'python': platform.python_version(),
+            'server': {
+                'latency': options['latency'],
+                'error_rate': options['error_rate'],
+                'reject_rate': options['reject_rate'],
+                'challenge': options['challenge'],
+                'statuses': statuses,
+            },
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='UTF-8') as output:
+                output.write(report + "\n")
+            self.stderr.write(self.style.SUCCESS(f"✅ Benchmark results written to {options['output']}"))
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,152 @@
+"""
+Janeway Management command for minting or updating DOIs for many preprints at once with the EZID plugin
+"""
+
+import json
+from datetime import date
+from functools import partial
+from django.core.management.base import BaseCommand, CommandError
+from plugins.ezid.logic import mint_preprint_doi, update_preprint_doi, preprint_deposit
+from plugins.ezid import async_bulk, audit, bulk, metrics, preflight, ratelimit, validation
+from plugins.ezid.models import BulkRun
+
+SELECTION = ['repository', 'from_id', 'to_id', 'published_after', 'published_before', 'missing_doi', 'force', 'skip_invalid']
+
+class Command(BaseCommand):
+    """ Mints or updates the DOIs of a selection of published preprints using a pool of concurrent workers """
+    help = "Mints or updates DOIs via EZID for the preprints matching the given selection."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action", help="`mint` new DOIs or `update` the metadata of existing DOIs", choices=["mint", "update"])
+        parser.add_argument(
+            "--repository", help="`short_name` of the repository to select preprints from", type=str)
+        parser.add_argument(
+            "--from-id", help="lowest preprint `id` to select", type=int)
+        parser.add_argument(
+            "--to-id", help="highest preprint `id` to select", type=int)
+        parser.add_argument(
+            "--published-after", help="select preprints published on or after this date (YYYY-MM-DD)", type=date.fromisoformat)
+        parser.add_argument(
+            "--published-before", help="select preprints published on or before this date (YYYY-MM-DD)", type=date.fromisoformat)
+        parser.add_argument(
+            "--missing-doi", help="select only preprints without a preprint_doi", action="store_true")
+        parser.add_argument(
+            "--workers", help="number of concurrent EZID requests", type=int, default=bulk.DEFAULT_WORKERS)
+        parser.add_argument(
+            "--max-rps", help="maximum number of EZID requests per second for each EZID account", type=float)
+        parser.add_argument(
+            "--shared-rate-limit", help="share the --max-rps budget with other processes through the Django cache", action="store_true")
+        parser.add_argument(
+            "--force", help="when updating, send every item even if its metadata is unchanged since the last deposit", action="store_true")
+        parser.add_argument(
+            "--async", help="send the requests from a single asyncio event loop instead of a thread pool, for large backfills", action="store_true", dest="use_async")
+        parser.add_argument(
+            "--skip-invalid", help="leave out the preprints preflight_ezid_doi finds invalid instead of sending them to EZID", action="store_true")
+        parser.add_argument(
+            "--dry-run", help="render and validate the preprints' deposits against the Crossref schema without sending them", action="store_true")
+        parser.add_argument(
+            "--resume", help="`id` of an interrupted run to continue, with the selection it was started with", type=int)
+        parser.add_argument(
+            "--retry-failed", help="with --resume, send the items the run failed on again as well, even if the run has finished", action="store_true")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if options['retry_failed'] and not options['resume']:
+            raise CommandError('--retry-failed needs --resume.')
+        checkpoint = None
+        if options['resume']:
+            try:
+                checkpoint = bulk.Checkpoint(BulkRun.objects.get(pk=options['resume'], command='bulk_ezid_doi', action=action))
+            except BulkRun.DoesNotExist:
+                raise CommandError(f"No bulk_ezid_doi {action} run {options['resume']} to resume.")
+            if checkpoint.run.finished and not options['retry_failed']:
+                raise CommandError(f"Run {options['resume']} has already finished.")
+            options.update(json.loads(checkpoint.run.selection))
+            for d in ['published_after', 'published_before']:
+                if options[d]:
+                    options[d] = date.fromisoformat(options[d])
+
+        selectors = ['repository', 'from_id', 'to_id', 'published_after', 'published_before', 'missing_doi']
+        if not any(options.get(s) not in (None, False) for s in selectors):
+            raise CommandError('Select preprints with at least one of --repository, --from-id, --to-id, --published-after, --published-before or --missing-doi.')
+        if action == "update" and options['missing_doi']:
+            raise CommandError('--missing-doi cannot be combined with update, preprints without a DOI have nothing to update.')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+
+        preprints = bulk.select_preprints(short_name=options['repository'],
+                                          from_id=options['from_id'],
+                                          to_id=options['to_id'],
+                                          published_after=options['published_after'],
+                                          published_before=options['published_before'],
+                                          missing_doi=options['missing_doi'])
+        if options['max_rps']:
+            ratelimit.configure(options['max_rps'], shared=options['shared_rate_limit'])
+        deposit = mint_preprint_doi if action == "mint" else partial(update_preprint_doi, force=options['force'])
+        prepare = partial(preprint_deposit, action=action, force=options['force'])
+        if options['skip_invalid']:
+            deposit = preflight.skip_invalid(deposit, preflight.preprint_problems)
+            prepare = preflight.skip_invalid(prepare, preflight.preprint_problems)
+        if checkpoint:
+            preprints = checkpoint.remaining(preprints, retry_failed=options['retry_failed'])
+        if options['dry_run']:
+            return self.dry_run(preprints, prepare)
+        if not checkpoint:
+            checkpoint = bulk.Checkpoint.start('bulk_ezid_doi', action, {s: options[s] for s in SELECTION})
+
+        self.stdout.write(f"Run {checkpoint.run.pk}: attempting to {action} DOIs for {preprints.count()} preprints with {options['workers']} workers")
+
+        if options['use_async']:
+            deposits = async_bulk.run_async_deposits(preprints, prepare, workers=options['workers'], progress=checkpoint.progress)
+        else:
+            deposits = bulk.run_deposits(preprints, deposit, workers=options['workers'], progress=checkpoint.progress)
+
+        results = []
+        with audit.buffered():
+            completed = False
+            try:
+                for result in deposits:
+                    results.append(result)
+                    checkpoint.record(result)
+                completed = True
+            except KeyboardInterrupt:
+                self.stdout.write(self.style.WARNING('Interrupted.'))
+            finally:
+                checkpoint.save(finished=completed)
+                metrics.flush()
+
+        for result in sorted(results, key=lambda r: r.item.pk):
+            if not result.enabled:
+                self.stdout.write(self.style.WARNING(f'{result.item}: {result.msg}'))
+            elif not result.success:
+                self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'✅ {result.item}: DOI {action} succeeded'))
+
+        succeeded = sum(1 for r in results if r.success)
+        self.stdout.write(f"{len(results)} preprints processed: {succeeded} succeeded, {len(results) - succeeded} failed or skipped")
+        paced, waited = ratelimit.wait_stats()
+        if paced:
+            self.stdout.write(f"{paced} requests waited {waited:.1f}s in total for the rate limit")
+        if not completed:
+            self.stdout.write(f"To resume this run pass --resume {checkpoint.run.pk}")
+
+    def dry_run(self, preprints, prepare):
+        invalid = 0
+        well_formed_only = 0
+        for result in validation.dry_run(preprints, prepare):
+            if not result.enabled:
+                self.stdout.write(self.style.WARNING(f'{result.item}: {result.msg}'))
+            elif not result.success:
+                invalid += 1
+                self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+            elif result.msg == validation.WELL_FORMED_ONLY:
+                well_formed_only += 1
+        if invalid:
+            self.stdout.write(self.style.ERROR(f"Dry run: {invalid} preprints would be rejected, nothing was sent to EZID"))
+        elif well_formed_only:
+            self.stdout.write(self.style.WARNING(f"Dry run: well-formedness only, no Crossref schema was loaded for {well_formed_only} preprints; "
+                                                 "nothing was sent to EZID"))
+        else:
+            self.stdout.write(self.style.SUCCESS("✅ Dry run: every deposit is valid, nothing was sent to EZID"))
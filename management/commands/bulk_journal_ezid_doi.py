@@ -0,0 +1,153 @@
+import json
+from datetime import date
+from functools import partial
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.models import Journal, Issue
+from plugins.ezid import async_bulk, audit, bulk, logic, metrics, preflight, validation
+from plugins.ezid import ratelimit
+from plugins.ezid.models import BulkRun
+
+SELECTION = ['journal', 'issue', 'published_after', 'published_before', 'after_id', 'force', 'skip_invalid']
+
+class Command(BaseCommand):
+    """Registers or updates the DOIs of every article in a journal, issue or publication date range via EZID"""
+    help = "Registers or updates the DOIs of every article in a journal, issue or publication date range via EZID"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action", help="`register` new DOIs or `update` already registered DOIs", choices=["register", "update"])
+        parser.add_argument(
+            "--journal", help="`code` of the journal to select articles from", type=str)
+        parser.add_argument(
+            "--issue", help="`id` of the issue to select articles from", type=int)
+        parser.add_argument(
+            "--published-after", help="select articles published on or after this date (YYYY-MM-DD)", type=date.fromisoformat)
+        parser.add_argument(
+            "--published-before", help="select articles published on or before this date (YYYY-MM-DD)", type=date.fromisoformat)
+        parser.add_argument(
+            "--after-id", help="skip articles up to and including this `id`", type=int)
+        parser.add_argument(
+            "--workers", help="number of concurrent EZID requests", type=int, default=bulk.DEFAULT_WORKERS)
+        parser.add_argument(
+            "--max-rps", help="maximum number of EZID requests per second for each EZID account", type=float)
+        parser.add_argument(
+            "--shared-rate-limit", help="share the --max-rps budget with other processes through the Django cache", action="store_true")
+        parser.add_argument(
+            "--force", help="when updating, send every item even if its metadata is unchanged since the last deposit", action="store_true")
+        parser.add_argument(
+            "--async", help="send the requests from a single asyncio event loop instead of a thread pool, for large backfills", action="store_true", dest="use_async")
+        parser.add_argument(
+            "--skip-invalid", help="leave out the articles preflight_ezid_doi finds invalid instead of sending them to EZID", action="store_true")
+        parser.add_argument(
+            "--dry-run", help="render and validate the articles' deposits against the Crossref schema without sending them", action="store_true")
+        parser.add_argument(
+            "--resume", help="`id` of an interrupted run to continue, with the selection it was started with", type=int)
+        parser.add_argument(
+            "--retry-failed", help="with --resume, send the items the run failed on again as well, even if the run has finished", action="store_true")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if options['retry_failed'] and not options['resume']:
+            raise CommandError('--retry-failed needs --resume.')
+        checkpoint = None
+        if options['resume']:
+            try:
+                checkpoint = bulk.Checkpoint(BulkRun.objects.get(pk=options['resume'], command='bulk_journal_ezid_doi', action=action))
+            except BulkRun.DoesNotExist:
+                raise CommandError(f"No bulk_journal_ezid_doi {action} run {options['resume']} to resume.")
+            if checkpoint.run.finished and not options['retry_failed']:
+                raise CommandError(f"Run {options['resume']} has already finished.")
+            options.update(json.loads(checkpoint.run.selection))
+            for d in ['published_after', 'published_before']:
+                if options[d]:
+                    options[d] = date.fromisoformat(options[d])
+
+        if not any(options.get(s) for s in ['journal', 'issue', 'published_after', 'published_before']):
+            raise CommandError('Select articles with at least one of --journal, --issue, --published-after or --published-before.')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+
+        journal = issue = None
+        if options['journal']:
+            try:
+                journal = Journal.objects.get(code=options['journal'])
+            except Journal.DoesNotExist:
+                raise CommandError(f"Journal {options['journal']} does not exist.")
+        if options['issue']:
+            try:
+                issue = Issue.objects.get(pk=options['issue'])
+            except Issue.DoesNotExist:
+                raise CommandError(f"Issue {options['issue']} does not exist.")
+
+        articles = bulk.select_articles(journal=journal,
+                                        issue=issue,
+                                        published_after=options['published_after'],
+                                        published_before=options['published_before'],
+                                        after_id=options['after_id'])
+        deposit = logic.register_journal_doi if action == "register" else partial(logic.update_journal_doi, force=options['force'])
+        prepare = partial(logic.journal_deposit, action=action, force=options['force'])
+        if options['skip_invalid']:
+            deposit = preflight.skip_invalid(deposit, preflight.article_problems)
+            prepare = preflight.skip_invalid(prepare, preflight.article_problems)
+        if checkpoint:
+            articles = checkpoint.remaining(articles, retry_failed=options['retry_failed'])
+        if options['dry_run']:
+            return self.dry_run(articles, prepare)
+        if not checkpoint:
+            checkpoint = bulk.Checkpoint.start('bulk_journal_ezid_doi', action, {s: options[s] for s in SELECTION})
+        if options['max_rps']:
+            ratelimit.configure(options['max_rps'], shared=options['shared_rate_limit'])
+        progress = checkpoint.progress
+
+        self.stdout.write(f"Run {checkpoint.run.pk}: attempting to {action} DOIs for {articles.count()} articles with {options['workers']} workers")
+
+        results = []
+        completed = False
+        try:
+            with audit.buffered():
+                if options['use_async']:
+                    deposits = async_bulk.run_async_deposits(articles, prepare, workers=options['workers'], progress=progress)
+                else:
+                    deposits = bulk.run_deposits(articles, deposit, workers=options['workers'], progress=progress)
+                for result in deposits:
+                    results.append(result)
+                    checkpoint.record(result)
+                    if not result.enabled:
+                        self.stdout.write(self.style.WARNING(f'{result.item}: {result.msg}'))
+                    elif not result.success:
+                        self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+                    else:
+                        self.stdout.write(self.style.SUCCESS(f'✅ DOI {action} succeeded for {result.item}'))
+            completed = True
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Interrupted.'))
+        finally:
+            checkpoint.save(finished=completed)
+            metrics.flush()
+            succeeded = sum(1 for r in results if r.success)
+            self.stdout.write(f"{len(results)} articles processed: {succeeded} succeeded, {len(results) - succeeded} failed or skipped")
+            paced, waited = ratelimit.wait_stats()
+            if paced:
+                self.stdout.write(f"{paced} requests waited {waited:.1f}s in total for the rate limit")
+            if not completed:
+                self.stdout.write(f"To resume this run pass --resume {checkpoint.run.pk}")
+
+    def dry_run(self, articles, prepare):
+        invalid = 0
+        well_formed_only = 0
+        for result in validation.dry_run(articles, prepare):
+            if not result.enabled:
+                self.stdout.write(self.style.WARNING(f'{result.item}: {result.msg}'))
+            elif not result.success:
+                invalid += 1
+                self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+            elif result.msg == validation.WELL_FORMED_ONLY:
+                well_formed_only += 1
+        if invalid:
+            self.stdout.write(self.style.ERROR(f"Dry run: {invalid} articles would be rejected, nothing was sent to EZID"))
+        elif well_formed_only:
+            self.stdout.write(self.style.WARNING(f"Dry run: well-formedness only, no Crossref schema was loaded for {well_formed_only} articles; "
+                                                 "nothing was sent to EZID"))
+        else:
+            self.stdout.write(self.style.SUCCESS("✅ Dry run: every deposit is valid, nothing was sent to EZID"))
@@ -0,0 +1,53 @@
+"""
+Janeway Management command that sends the deposits in an EZID spool file, without using the database
+"""
+
+import os
+from django.core.management.base import BaseCommand, CommandError
+from plugins.ezid import bulk, ratelimit, spool
+
+class Command(BaseCommand):
+    """ Streams a spool file written by export_ezid_spool to EZID, appending the outcome of every request to a results file """
+    help = "Sends the deposits in an EZID spool file and records the responses in a results file."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "spool", help="path of the JSONL spool file written by export_ezid_spool", type=str)
+        parser.add_argument(
+            "results", help="path of the JSONL results file to append to, deposits it records as successful are not sent again", type=str)
+        parser.add_argument(
+            "--workers", help="number of concurrent EZID requests", type=int, default=bulk.DEFAULT_WORKERS)
+        parser.add_argument(
+            "--max-rps", help="maximum number of EZID requests per second for each EZID account", type=float)
+        parser.add_argument(
+            "--shared-rate-limit", help="share the --max-rps budget with other processes through the Django cache", action="store_true")
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+        if options['max_rps']:
+            ratelimit.configure(options['max_rps'], shared=options['shared_rate_limit'])
+
+        already_sent = set()
+        if os.path.exists(options['results']):
+            with open(options['results'], encoding='UTF-8') as results_file:
+                already_sent = spool.read_succeeded(results_file)
+            if already_sent:
+                self.stdout.write(f"{len(already_sent)} deposits already succeeded according to {options['results']}, not sending them again")
+
+        results = []
+        with open(options['spool'], encoding='UTF-8') as spool_file, open(options['results'], 'a', encoding='UTF-8') as results_file:
+            records = spool.read_spool(spool_file)
+            for result in spool.deposit_spool(records, results_file, workers=options['workers'], skip=already_sent):
+                results.append(result)
+                record = result.item
+                if not result.enabled:
+                    self.stdout.write(self.style.WARNING(f'{record.model} {record.pk}: {result.msg}'))
+                elif not result.success:
+                    self.stdout.write(self.style.ERROR(f'{record.model} {record.pk}: {result.msg}'))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f'✅ DOI {record.action} succeeded for {record.model} {record.pk}'))
+
+        succeeded = sum(1 for r in results if r.success)
+        self.stdout.write(f"{len(results)} deposits sent: {succeeded} succeeded, {len(results) - succeeded} failed")
+        self.stdout.write(f"Run apply_ezid_spool_results {options['results']} on a host with database access to record them in Janeway")
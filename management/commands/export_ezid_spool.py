@@ -0,0 +1,101 @@
+"""
+Janeway Management command that renders EZID deposits into a spool file for deposit_ezid_spool
+"""
+
+from datetime import date
+from functools import partial
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.models import Journal, Issue
+from plugins.ezid import bulk, logic, spool
+
+ACTIONS = {
+    'preprints': ['mint', 'update'],
+    'articles': ['register', 'update'],
+}
+
+class Command(BaseCommand):
+    """ Renders the EZID requests for a selection of preprints or articles into a JSONL spool file, without sending them """
+    help = "Writes the EZID deposits for the selected preprints or articles to a JSONL spool file."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "kind", help="deposit `preprints` or journal `articles`", choices=list(ACTIONS))
+        parser.add_argument(
+            "action", help="`mint` (preprints), `register` (articles) or `update` (either)", choices=["mint", "register", "update"])
+        parser.add_argument(
+            "spool", help="path of the JSONL spool file to write", type=str)
+        parser.add_argument(
+            "--repository", help="`short_name` of the repository to select preprints from", type=str)
+        parser.add_argument(
+            "--from-id", help="lowest preprint `id` to select", type=int)
+        parser.add_argument(
+            "--to-id", help="highest preprint `id` to select", type=int)
+        parser.add_argument(
+            "--missing-doi", help="select only preprints without a preprint_doi", action="store_true")
+        parser.add_argument(
+            "--journal", help="`code` of the journal to select articles from", type=str)
+        parser.add_argument(
+            "--issue", help="`id` of the issue to select articles from", type=int)
+        parser.add_argument(
+            "--after-id", help="skip articles up to and including this `id`", type=int)
+        parser.add_argument(
+            "--published-after", help="select items published on or after this date (YYYY-MM-DD)", type=date.fromisoformat)
+        parser.add_argument(
+            "--published-before", help="select items published on or before this date (YYYY-MM-DD)", type=date.fromisoformat)
+        parser.add_argument(
+            "--force", help="when updating, spool every item even if its metadata is unchanged since the last deposit", action="store_true")
+
+    def handle(self, *args, **options):
+        kind, action = options['kind'], options['action']
+        if action not in ACTIONS[kind]:
+            raise CommandError(f"{kind} can only be spooled for {' or '.join(ACTIONS[kind])}.")
+
+        if kind == 'preprints':
+            selectors = ['repository', 'from_id', 'to_id', 'published_after', 'published_before', 'missing_doi']
+            if not any(options.get(s) not in (None, False) for s in selectors):
+                raise CommandError('Select preprints with at least one of --repository, --from-id, --to-id, --published-after, --published-before or --missing-doi.')
+            items = bulk.select_preprints(short_name=options['repository'],
+                                          from_id=options['from_id'],
+                                          to_id=options['to_id'],
+                                          published_after=options['published_after'],
+                                          published_before=options['published_before'],
+                                          missing_doi=options['missing_doi'])
+            prepare = partial(logic.preprint_deposit, action=action, force=options['force'])
+        else:
+            if not any(options.get(s) for s in ['journal', 'issue', 'published_after', 'published_before']):
+                raise CommandError('Select articles with at least one of --journal, --issue, --published-after or --published-before.')
+            journal = issue = None
+            if options['journal']:
+                try:
+                    journal = Journal.objects.get(code=options['journal'])
+                except Journal.DoesNotExist:
+                    raise CommandError(f"Journal {options['journal']} does not exist.")
+            if options['issue']:
+                try:
+                    issue = Issue.objects.get(pk=options['issue'])
+                except Issue.DoesNotExist:
+                    raise CommandError(f"Issue {options['issue']} does not exist.")
+            items = bulk.select_articles(journal=journal,
+                                         issue=issue,
+                                         published_after=options['published_after'],
+                                         published_before=options['published_before'],
+                                         after_id=options['after_id'])
+            prepare = partial(logic.journal_deposit, action=action, force=options['force'])
+
+        spooled = skipped = 0
+        with open(options['spool'], 'w', encoding='UTF-8') as spool_file:
+            for item, result in spool.export_spool(items, prepare, spool_file):
+                if result is None:
+                    spooled += 1
+                    continue
+                skipped += 1
+                enabled, success, msg = result
+                if not enabled:
+                    self.stdout.write(self.style.WARNING(f'{item}: {msg}'))
+                elif not success:
+                    self.stdout.write(self.style.ERROR(f'{item}: {msg}'))
+                else:
+                    self.stdout.write(f'{item}: {msg}')
+
+        self.stdout.write(self.style.SUCCESS(f"✅ {spooled} deposits written to {options['spool']}, {skipped} {kind} skipped"))
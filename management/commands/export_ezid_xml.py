@@ -0,0 +1,102 @@
+"""
+Janeway Management command that exports the Crossref XML of every DOI of a repository or journal
+"""
+
+import gzip
+import io
+import sys
+from functools import partial
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from journal.models import Journal
+from repository.models import Repository
+from plugins.ezid import bulk, export, logic, sync
+
+class Command(BaseCommand):
+    """ Streams the Crossref XML an update would deposit for every preprint or article with a DOI to a file or stdout """
+    help = "Exports the Crossref deposit XML of every preprint of a repository or article of a journal."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output", help="path of the file to write, or - for stdout", type=str)
+        parser.add_argument(
+            "--repository", help="`short_name` of the repository whose preprints to export", type=str)
+        parser.add_argument(
+            "--journal", help="`code` of the journal whose articles to export", type=str)
+        parser.add_argument(
+            "--gzip", help="compress the export with gzip", action="store_true")
+        parser.add_argument(
+            "--chunk-size", help="number of items loaded from the database at a time", type=int, default=bulk.CHUNK_SIZE)
+        parser.add_argument(
+            "--crossref-batch", help="write a single Crossref doi_batch that can be uploaded to Crossref instead of the export document", action="store_true")
+        parser.add_argument(
+            "--batch-id", help="doi_batch_id of the Crossref batch, by default ezid_export_ and the current time", type=str)
+        parser.add_argument(
+            "--depositor-name", help="depositor of the Crossref batch, required for a repository; a journal's batch uses its Crossref settings", type=str)
+        parser.add_argument(
+            "--depositor-email", help="email address of the depositor of the Crossref batch", type=str)
+        parser.add_argument(
+            "--registrant", help="registrant of the Crossref batch, the depositor by default", type=str)
+
+    def handle(self, *args, **options):
+        if bool(options['repository']) == bool(options['journal']):
+            raise CommandError('Select either --repository or --journal.')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+        if bool(options['depositor_name']) != bool(options['depositor_email']):
+            raise CommandError('Give both --depositor-name and --depositor-email.')
+        if options['crossref_batch'] and options['repository'] and not options['depositor_name']:
+            raise CommandError('A Crossref batch of preprints needs --depositor-name and --depositor-email.')
+
+        if options['repository']:
+            try:
+                repository = Repository.objects.get(short_name=options['repository'])
+            except Repository.DoesNotExist:
+                raise CommandError(f"Repository {options['repository']} does not exist.")
+            items = sync.preprint_candidates(repository, None)
+            prepare = partial(logic.preprint_deposit, action="update", force=True)
+        else:
+            try:
+                journal = Journal.objects.get(code=options['journal'])
+            except Journal.DoesNotExist:
+                raise CommandError(f"Journal {options['journal']} does not exist.")
+            items = sync.article_candidates(journal, None)
+            prepare = partial(logic.journal_deposit, action="update", force=True)
+
+        to_stdout = options['output'] == '-'
+        # keep the messages out of the export when it goes to stdout
+        log = self.stderr if to_stdout else self.stdout
+        if to_stdout:
+            out = io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb'), encoding='UTF-8') if options['gzip'] else sys.stdout
+        elif options['gzip']:
+            out = gzip.open(options['output'], 'wt', encoding='UTF-8')
+        else:
+            out = open(options['output'], 'w', encoding='UTF-8')
+
+        if options['crossref_batch']:
+            batch_id = options['batch_id'] or f"ezid_export_{timezone.now():%Y%m%d%H%M%S}"
+            head = None
+            if options['depositor_name']:
+                head = export.batch_head(batch_id, options['depositor_name'], options['depositor_email'],
+                                         options['registrant'] or options['depositor_name'])
+            results = export.write_batch(items, prepare, out, batch_id, head, options['chunk_size'])
+        else:
+            results = export.write_export(items, prepare, out, options['chunk_size'])
+
+        exported = skipped = 0
+        try:
+            for item, result in results:
+                if result is None:
+                    exported += 1
+                    continue
+                skipped += 1
+                enabled, success, msg = result
+                log.write(self.style.WARNING(f'{item}: {msg}') if not enabled else self.style.ERROR(f'{item}: {msg}'))
+        finally:
+            if out is sys.stdout:
+                out.flush()
+            else:
+                out.close()
+
+        log.write(self.style.SUCCESS(f"✅ {exported} deposits exported, {skipped} skipped"))
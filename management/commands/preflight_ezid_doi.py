@@ -0,0 +1,66 @@
+"""
+Janeway Management command that checks the metadata of a whole repository or journal before depositing it with EZID
+"""
+
+import json
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.models import Journal
+from repository.models import Repository
+from plugins.ezid import bulk, preflight
+
+class Command(BaseCommand):
+    """ Reports the invalid ISSNs, ORCIDs, DOIs and missing target URLs of a repository or journal without contacting EZID """
+    help = "Checks every preprint of a repository or article of a journal for metadata EZID would reject or drop."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repository", help="`short_name` of the repository whose preprints to check", type=str)
+        parser.add_argument(
+            "--journal", help="`code` of the journal whose articles to check", type=str)
+        parser.add_argument(
+            "--report", help="path of a JSONL file to write the problems to", type=str)
+
+    def handle(self, *args, **options):
+        if bool(options['repository']) == bool(options['journal']):
+            raise CommandError('Select either --repository or --journal.')
+
+        if options['repository']:
+            if not Repository.objects.filter(short_name=options['repository']).exists():
+                raise CommandError(f"Repository {options['repository']} does not exist.")
+            items = bulk.select_preprints(short_name=options['repository'])
+            check = preflight.preprint_problems
+        else:
+            try:
+                journal = Journal.objects.get(code=options['journal'])
+            except Journal.DoesNotExist:
+                raise CommandError(f"Journal {options['journal']} does not exist.")
+            items = bulk.select_articles(journal=journal)
+            check = preflight.article_problems
+
+        fields = Counter()
+        invalid = set()
+        report = open(options['report'], 'w', encoding='UTF-8') if options['report'] else None
+        try:
+            for problem in preflight.scan(items, check):
+                fields[problem.field] += 1
+                if problem.fatal:
+                    invalid.add(problem.item.pk)
+                    self.stdout.write(self.style.ERROR(f'{problem.item}: invalid {problem.field} {problem.value!r}'))
+                else:
+                    self.stdout.write(self.style.WARNING(f'{problem.item}: invalid {problem.field} {problem.value!r}, omitted from the deposit'))
+                if report:
+                    report.write(json.dumps({'pk': problem.item.pk, 'item': str(problem.item), 'field': problem.field,
+                                             'value': problem.value, 'fatal': problem.fatal}) + "\n")
+        finally:
+            if report:
+                report.close()
+
+        summary = ", ".join(f"{count} {field}" for field, count in sorted(fields.items()))
+        if invalid:
+            self.stdout.write(self.style.ERROR(f"{len(invalid)} items would fail to deposit ({summary}), pass --skip-invalid to the bulk commands to leave them out"))
+        elif fields:
+            self.stdout.write(self.style.WARNING(f"✅ no item would fail to deposit, some values would be omitted ({summary})"))
+        else:
+            self.stdout.write(self.style.SUCCESS("✅ no problems found"))
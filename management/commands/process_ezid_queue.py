@@ -0,0 +1,46 @@
+"""
+Janeway Management command that sends queued DOI deposits to EZID
+"""
+
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from plugins.ezid import audit, bulk, logic
+
+class Command(BaseCommand):
+    """ Drains the EZID deposit queue filled by the preprint_publication hook and recording the results on each queue row """
+    help = "Sends queued DOI deposits to EZID."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", help="maximum number of deposits to claim at once", type=int, default=100)
+        parser.add_argument(
+            "--workers", help="number of concurrent EZID requests", type=int, default=bulk.DEFAULT_WORKERS)
+        parser.add_argument(
+            "--loop", help="keep polling the queue instead of exiting once it is empty", action="store_true")
+        parser.add_argument(
+            "--sleep", help="seconds to wait between polls when looping", type=float, default=10)
+        parser.add_argument(
+            "--stale-after", help="minutes after which a running deposit is assumed abandoned and queued again", type=int, default=30)
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['limit'] < 1:
+            raise CommandError('--workers and --limit must be at least 1.')
+
+        while True:
+            logic.requeue_stale_deposits(timezone.now() - timedelta(minutes=options['stale_after']))
+            queued = logic.claim_queued_deposits(options['limit'])
+            with audit.buffered():
+                for result in bulk.run_deposits(queued, logic.process_queued_deposit, workers=options['workers']):
+                    if not result.enabled:
+                        self.stdout.write(self.style.WARNING(f'{result.item}: {result.msg}'))
+                    elif not result.success:
+                        self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+                    else:
+                        self.stdout.write(self.style.SUCCESS(f'✅ {result.item}'))
+
+            if not queued:
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
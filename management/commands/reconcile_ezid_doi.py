@@ -0,0 +1,96 @@
+"""
+Janeway Management command that reports the DOIs whose EZID record has drifted from Janeway's metadata
+"""
+
+import json
+from functools import partial
+from django.core.management.base import BaseCommand, CommandError
+
+from journal.models import Journal
+from repository.models import Repository
+from plugins.ezid import audit, bulk, logic, ratelimit, reconcile, spool, sync
+
+class Command(BaseCommand):
+    """ Compares the record EZID holds for every DOI of a repository or journal with the metadata an update would send now """
+    help = "Reports the preprints or articles whose EZID record differs from their current metadata, optionally updating them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repository", help="`short_name` of the repository whose preprints to reconcile", type=str)
+        parser.add_argument(
+            "--journal", help="`code` of the journal whose articles to reconcile", type=str)
+        parser.add_argument(
+            "--workers", help="number of concurrent EZID requests", type=int, default=bulk.DEFAULT_WORKERS)
+        parser.add_argument(
+            "--max-rps", help="maximum number of EZID requests per second for each EZID account", type=float)
+        parser.add_argument(
+            "--refresh", help="read every record from EZID again instead of using the ones cached by an earlier run", action="store_true")
+        parser.add_argument(
+            "--report", help="path of a JSONL file to write the drifted items and the reasons to", type=str)
+        parser.add_argument(
+            "--spool", help="path of a spool file to write the updates of the drifted items to, for deposit_ezid_spool", type=str)
+        parser.add_argument(
+            "--update", help="send the updates of the drifted items to EZID", action="store_true")
+
+    def handle(self, *args, **options):
+        if bool(options['repository']) == bool(options['journal']):
+            raise CommandError('Select either --repository or --journal.')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+        if options['max_rps']:
+            ratelimit.configure(options['max_rps'])
+
+        if options['repository']:
+            try:
+                repository = Repository.objects.get(short_name=options['repository'])
+            except Repository.DoesNotExist:
+                raise CommandError(f"Repository {options['repository']} does not exist.")
+            items = sync.preprint_candidates(repository, None)
+            prepare = partial(logic.preprint_deposit, action="update", force=True)
+            deposit = partial(logic.update_preprint_doi, force=True)
+        else:
+            try:
+                journal = Journal.objects.get(code=options['journal'])
+            except Journal.DoesNotExist:
+                raise CommandError(f"Journal {options['journal']} does not exist.")
+            items = bulk.select_articles(journal=journal).filter(identifier__id_type='doi').distinct()
+            prepare = partial(logic.journal_deposit, action="update", force=True)
+            deposit = partial(logic.update_journal_doi, force=True)
+
+        check = partial(reconcile.check, prepare, refresh=options['refresh'])
+        drifted = []
+        in_sync = 0
+        report = open(options['report'], 'w', encoding='UTF-8') if options['report'] else None
+        try:
+            for result in bulk.run_deposits(items, check, workers=options['workers']):
+                if not result.enabled:
+                    self.stdout.write(self.style.WARNING(f'{result.item}: {result.msg}'))
+                elif result.success:
+                    in_sync += 1
+                else:
+                    drifted.append(result.item.pk)
+                    self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+                    if report:
+                        report.write(json.dumps({'pk': result.item.pk, 'item': str(result.item), 'reasons': result.msg}) + "\n")
+        finally:
+            if report:
+                report.close()
+        self.stdout.write(self.style.SUCCESS(f'✅ {in_sync} in sync, {len(drifted)} drifted'))
+
+        # the results only keep the pks, select the drifted items again to send them
+        drifted_items = items.filter(pk__in=drifted)
+        if options['spool'] and drifted:
+            with open(options['spool'], 'w', encoding='UTF-8') as spool_file:
+                spooled = sum(1 for item, result in spool.export_spool(drifted_items, prepare, spool_file) if result is None)
+            self.stdout.write(self.style.SUCCESS(f"✅ {spooled} updates written to {options['spool']}"))
+
+        if options['update'] and drifted:
+            updated = 0
+            with audit.buffered():
+                update = partial(reconcile.update, deposit, prepare)
+                for result in bulk.run_deposits(drifted_items, update, workers=options['workers']):
+                    if result.success:
+                        updated += 1
+                    else:
+                        self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+            self.stdout.write(self.style.SUCCESS(f'✅ {updated} of {len(drifted)} drifted DOIs updated'))
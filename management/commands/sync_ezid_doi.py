@@ -0,0 +1,77 @@
+"""
+Janeway Management command that updates the DOIs of the preprints and articles changed since the last sync
+"""
+
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from journal.models import Journal
+from plugins.ezid import audit, bulk, logic, ratelimit, sync
+from plugins.ezid.config import get_journal_config
+from plugins.ezid.models import RepoEZIDSettings
+
+class Command(BaseCommand):
+    """ Sends metadata updates to EZID for the items changed since each repository's or journal's high-water mark, advancing the mark when all of them succeed """
+    help = "Updates the DOIs of the preprints and articles whose metadata changed since the last sync."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repository", help="`short_name` of a repository to sync, instead of every repository with EZID settings", type=str, action="append", default=[])
+        parser.add_argument(
+            "--journal", help="`code` of a journal to sync, instead of every journal with EZID enabled", type=str, action="append", default=[])
+        parser.add_argument(
+            "--since", help="sync the items changed after this date (YYYY-MM-DD) instead of after the recorded high-water mark", type=datetime.fromisoformat)
+        parser.add_argument(
+            "--all", help="treat every item as a candidate, e.g. for a first sync", action="store_true")
+        parser.add_argument(
+            "--workers", help="number of concurrent EZID requests", type=int, default=bulk.DEFAULT_WORKERS)
+        parser.add_argument(
+            "--max-rps", help="maximum number of EZID requests per second for each EZID account", type=float)
+        parser.add_argument(
+            "--shared-rate-limit", help="share the --max-rps budget with other processes through the Django cache", action="store_true")
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+        if options['max_rps']:
+            ratelimit.configure(options['max_rps'], shared=options['shared_rate_limit'])
+        since = options['since']
+        if since and timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+        repo_settings = RepoEZIDSettings.objects.select_related('repo')
+        journals = Journal.objects.all()
+        if options['repository'] or options['journal']:
+            repo_settings = repo_settings.filter(repo__short_name__in=options['repository'])
+            journals = journals.filter(code__in=options['journal'])
+        scopes = [(s.repo, sync.preprint_candidates, logic.update_preprint_doi, sync.PREPRINT_CHANGE_FIELDS) for s in repo_settings]
+        scopes += [(j, sync.article_candidates, logic.update_journal_doi, sync.ARTICLE_CHANGE_FIELDS)
+                   for j in journals if get_journal_config(j).enabled]
+
+        for scope, candidates, deposit, paths in scopes:
+            started = timezone.now()
+            mark = None if options['all'] else since or sync.get_high_water(scope)
+            if mark is None and not options['all']:
+                self.stdout.write(self.style.WARNING(f'{scope}: never synced, pass --since or --all for a first sync'))
+                continue
+
+            items = candidates(scope, mark)
+            if mark is not None and not sync.change_fields(items.model, paths):
+                self.stdout.write(self.style.WARNING(f'{scope}: no modification timestamps available, every item is a candidate'))
+            self.stdout.write(f"{scope}: {items.count()} candidates changed since {mark or 'the beginning'}")
+
+            results = []
+            with audit.buffered():
+                for result in bulk.run_deposits(items, deposit, workers=options['workers']):
+                    results.append(result)
+                    if result.enabled and not result.success:
+                        self.stdout.write(self.style.ERROR(f'{result.item}: {result.msg}'))
+
+            sent = sum(1 for r in results if r.success and str(r.msg).startswith('success:'))
+            failed = sum(1 for r in results if r.enabled and not r.success)
+            if failed:
+                self.stdout.write(self.style.ERROR(f'{scope}: {sent} updated, {failed} failed, the high-water mark stays at {mark or "unset"}'))
+            else:
+                sync.set_high_water(scope, started)
+                self.stdout.write(self.style.SUCCESS(f'✅ {scope}: {sent} updated, {len(results) - sent} unchanged'))
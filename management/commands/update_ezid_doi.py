@@ -18,6 +18,8 @@ class Command(BaseCommand):
         parser.add_argument(
             "preprint_id", help="`id` of preprint needing a DOI to be minted, OR a complete DOI URL", type=str
         )
+        parser.add_argument(
+            "--force", help="send the update even if the metadata is unchanged since the last deposit", action="store_true")
 
     def handle(self, *args, **options):
         short_name = options.get('short_name')
@@ -50,7 +52,7 @@ class Command(BaseCommand):
 
         self.stdout.write(f"Attempting to update DOI metadata for preprint {preprint_id}")
 
-        enabled, success, msg = update_preprint_doi(preprint)
+        enabled, success, msg = update_preprint_doi(preprint, force=options['force'])
 
         if not enabled:
             self.stdout.write(self.style.WARNING(msg))
@@ -12,6 +12,8 @@ class Command(BaseCommand):
         parser.add_argument(
             "article_id", help="`id` of article needing a DOI to be minted", type=int
         )
+        parser.add_argument(
+            "--force", help="send the update even if the metadata is unchanged since the last deposit", action="store_true")
 
     def handle(self, *args, **options):
         article_id = options['article_id']
@@ -22,7 +24,7 @@ class Command(BaseCommand):
         article = Article.objects.get(id=article_id)
         self.stdout.write(f"Attempting to update a DOI for Article {article}")
 
-        enabled, success, msg = logic.update_journal_doi(article)
+        enabled, success, msg = logic.update_journal_doi(article, force=options['force'])
 
         if not enabled:
             self.stdout.write(self.style.WARNING(msg))
@@ -0,0 +1,203 @@
+"""
+Timing and counters for the hot paths of the EZID plugin for Janeway
+
+Spans are timed into histograms and deposits counted by outcome, then handed to a sink chosen per deployment with
+EZID_METRICS: 'prometheus' keeps them for the metrics view in the Prometheus text format, 'log' logs a summary every
+EZID_METRICS_LOG_INTERVAL seconds, and a dotted path names any other Sink subclass. Without EZID_METRICS nothing is
+measured and the spans cost a single check.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# upper bounds, in seconds, of the span histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOG_INTERVAL = getattr(settings, 'EZID_METRICS_LOG_INTERVAL', 60)
+
+SPAN_SECONDS = 'ezid_span_seconds'
+DEPOSITS_TOTAL = 'ezid_deposits_total'
+
+HELP = {
+    SPAN_SECONDS: 'Seconds spent in each EZID plugin hot path',
+    DEPOSITS_TOTAL: 'EZID deposits completed, by action and outcome',
+}
+
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            self.buckets[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Sink:
+    ''' aggregates counters and histograms keyed by metric name and labels, subclasses decide what to do with them '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def flush(self):
+        ''' called at the end of the bulk commands '''
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class PrometheusSink(Sink):
+    ''' keeps the metrics of this process for the metrics view '''
+    def render(self):
+        ''' returns the metrics in the Prometheus text exposition format '''
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.buckets), h.count, h.sum)) for key, h in self.histograms.items())
+
+        lines = []
+        described = set()
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), (buckets, count, total) in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class LogSink(Sink):
+    ''' logs a summary of the metrics every interval seconds and when flushed, then starts over '''
+    def __init__(self, interval=LOG_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self.logged = time.monotonic()
+
+    def observe(self, name, value, **labels):
+        super().observe(name, value, **labels)
+        if time.monotonic() - self.logged >= self.interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+            self.logged = time.monotonic()
+        for (name, labels), h in sorted(histograms.items()):
+            logger.info(f'{name}{_labels(labels)}: {h.count} calls, {h.sum:.3f}s total, '
+                        f'{h.sum / h.count * 1000:.1f}ms mean, {h.max * 1000:.1f}ms max')
+        for (name, labels), value in sorted(counters.items()):
+            logger.info(f'{name}{_labels(labels)}: {value}')
+
+
+SINKS = {
+    'prometheus': PrometheusSink,
+    'log': LogSink,
+}
+
+def _load_sink(name):
+    if not name:
+        return None
+    return SINKS[name]() if name in SINKS else import_string(name)()
+
+_sink = _load_sink(getattr(settings, 'EZID_METRICS', None))
+
+def configure(sink):
+    ''' replaces the sink metrics are sent to, a Sink, a name accepted by EZID_METRICS, or None to stop measuring '''
+    global _sink
+    _sink = _load_sink(sink) if sink is None or isinstance(sink, str) else sink
+
+def get_sink():
+    return _sink
+
+def flush():
+    if _sink is not None:
+        _sink.flush()
+
+def increment(name, value=1, **labels):
+    if _sink is not None:
+        _sink.increment(name, value, **labels)
+
+@contextmanager
+def span(name):
+    ''' times the block as the named span '''
+    sink = _sink
+    if sink is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        sink.observe(SPAN_SECONDS, time.perf_counter() - started, span=name)
+
+def timed(name):
+    ''' decorator timing every call of a function or coroutine function as the named span '''
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _sink is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
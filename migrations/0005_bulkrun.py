@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0004_depositdigest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.CharField(max_length=50)),
+                ('action', models.CharField(max_length=20)),
+                ('selection', models.TextField()),
+                ('last_pk', models.PositiveIntegerField(null=True)),
+                ('done_pks', models.TextField(default='[]')),
+                ('failures', models.TextField(default='[]')),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('succeeded', models.PositiveIntegerField(default=0)),
+                ('finished', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('ezid', '0005_bulkrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DepositRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('action', models.CharField(max_length=20)),
+                ('doi', models.CharField(blank=True, max_length=255)),
+                ('success', models.BooleanField(default=False)),
+                ('status', models.PositiveSmallIntegerField(null=True)),
+                ('latency', models.FloatField(null=True)),
+                ('digest', models.CharField(blank=True, max_length=64)),
+                ('response', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'ordering': ('-created',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='depositrecord',
+            index=models.Index(fields=['content_type', 'object_id', 'created'], name='ezid_record_item_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='depositrecord',
+            index=models.Index(fields=['status', 'created'], name='ezid_record_status_idx'),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0007_syncstate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='depositrecord',
+            index=models.Index(fields=['success', 'created'], name='ezid_record_success_idx'),
+        ),
+    ]
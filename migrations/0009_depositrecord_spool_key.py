@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ezid', '0008_depositrecord_success_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='depositrecord',
+            name='spool_key',
+            field=models.CharField(blank=True, db_index=True, max_length=32),
+        ),
+    ]
@@ -1,3 +1,5 @@
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
 from repository.models import Repository
@@ -12,3 +14,113 @@ class RepoEZIDSettings(models.Model):
 
     def __str__(self):
         return "EZID settings: {}".format(self.repo)
+
+class QueuedDeposit(models.Model):
+    ''' a DOI deposit for a preprint or article waiting to be sent to EZID by the process_ezid_queue command '''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    item = GenericForeignKey('content_type', 'object_id')
+    action = models.CharField(max_length=20)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    enabled = models.BooleanField(null=True)
+    success = models.BooleanField(null=True)
+    result = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('created',)
+        indexes = [models.Index(fields=['status', 'created'], name='ezid_queue_status_idx')]
+
+    def __str__(self):
+        return "EZID {} of {} {}: {}".format(self.action, self.content_type.model, self.object_id, self.status)
+
+class DepositDigest(models.Model):
+    ''' digest of the last payload successfully deposited with EZID for a preprint or article '''
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    item = GenericForeignKey('content_type', 'object_id')
+    digest = models.CharField(max_length=64)
+    deposited = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+    def __str__(self):
+        return "EZID digest of {} {}: {}".format(self.content_type.model, self.object_id, self.digest)
+
+class DepositRecord(models.Model):
+    ''' outcome of one request sent to EZID for a preprint or article '''
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    item = GenericForeignKey('content_type', 'object_id')
+    action = models.CharField(max_length=20)
+    doi = models.CharField(max_length=255, blank=True)
+    success = models.BooleanField(default=False)
+    # HTTP status of the EZID response, empty when EZID could not be reached
+    status = models.PositiveSmallIntegerField(null=True)
+    # seconds spent sending the request, retries included
+    latency = models.FloatField(null=True)
+    digest = models.CharField(max_length=64, blank=True)
+    response = models.TextField(blank=True)
+    # key of the spool results line the record was applied from, empty for direct deposits
+    spool_key = models.CharField(max_length=32, blank=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('-created',)
+        indexes = [
+            models.Index(fields=['content_type', 'object_id', 'created'], name='ezid_record_item_idx'),
+            models.Index(fields=['status', 'created'], name='ezid_record_status_idx'),
+            models.Index(fields=['success', 'created'], name='ezid_record_success_idx'),
+        ]
+
+    def __str__(self):
+        return "EZID {} of {} {}: {}".format(self.action, self.content_type.model, self.object_id, self.status)
+
+class BulkRun(models.Model):
+    ''' checkpoint of a bulk_ezid_doi or bulk_journal_ezid_doi run, from which an interrupted run can be resumed '''
+    command = models.CharField(max_length=50)
+    action = models.CharField(max_length=20)
+    # JSON of the selection options the run was started with
+    selection = models.TextField()
+    # every item up to last_pk has been processed, along with the pks in done_pks (a JSON list)
+    last_pk = models.PositiveIntegerField(null=True)
+    done_pks = models.TextField(default='[]')
+    # JSON list of the pks of items whose deposit failed
+    failures = models.TextField(default='[]')
+    processed = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "EZID bulk run {}: {} {}, {} processed".format(self.pk, self.command, self.action, self.processed)
+
+class SyncState(models.Model):
+    ''' high-water mark of the sync_ezid_doi command for a repository or journal '''
+    scope_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    scope_id = models.PositiveIntegerField()
+    scope = GenericForeignKey('scope_type', 'scope_id')
+    # items changed after this time are candidates for the next sync
+    high_water = models.DateTimeField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('scope_type', 'scope_id'),)
+
+    def __str__(self):
+        return "EZID sync of {} {}: {}".format(self.scope_type.model, self.scope_id, self.high_water)
@@ -0,0 +1,65 @@
+"""
+Preflight validation of the preprints and articles of a repository or journal, for the EZID plugin for Janeway
+
+Finds the values that make a deposit fail or lose metadata before anything is sent to EZID: journal ISSNs,
+author ORCIDs, DOIs and target URLs. Problems marked fatal would fail the deposit, locally or at EZID, the others
+are dropped from the deposited metadata with a warning.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import re
+from collections import namedtuple
+
+from plugins.ezid import bulk, logic
+
+Problem = namedtuple('Problem', ['item', 'field', 'value', 'fatal'])
+
+_RE_DOI = re.compile(r'^10\.[0-9]{4,9}/\S+$')
+
+def preprint_problems(preprint):
+    ''' the problems with a preprint's metadata, for preprints selected with bulk.select_preprints '''
+    problems = []
+    for author in preprint.preprintauthor_set.all():
+        orcid = author.account.orcid if author.account else None
+        if orcid and not logic.get_valid_orcid(orcid):
+            problems.append(Problem(preprint, 'orcid', orcid, False))
+    if preprint.doi and not logic.is_valid_url(preprint.doi):
+        problems.append(Problem(preprint, 'published_doi', preprint.doi, False))
+    if preprint.preprint_doi and not _RE_DOI.match(preprint.preprint_doi):
+        problems.append(Problem(preprint, 'doi', preprint.preprint_doi, True))
+    return problems
+
+def article_problems(article):
+    ''' the problems with an article's metadata, for articles selected with bulk.select_articles '''
+    problems = []
+    issn = article.journal.issn
+    if not logic.is_valid_issn(issn) and not logic.is_valid_url(issn):
+        problems.append(Problem(article, 'issn', issn, True))
+    if not article.remote_url:
+        problems.append(Problem(article, 'remote_url', article.remote_url, True))
+    doi = logic.get_article_doi(article)
+    if doi and not _RE_DOI.match(doi):
+        problems.append(Problem(article, 'doi', doi, True))
+    for author in logic.get_frozen_authors(article):
+        # the journal templates prefix the ORCID with https://orcid.org/ themselves
+        if author.orcid and (author.orcid.startswith('http') or not logic.get_valid_orcid(author.orcid)):
+            problems.append(Problem(article, 'orcid', author.orcid, True))
+    return problems
+
+def scan(items, check, chunk_size=bulk.CHUNK_SIZE):
+    ''' yields the problems check(item) finds in a pk ordered selection, loading it a chunk at a time '''
+    for item in bulk.iterate(items, chunk_size):
+        yield from check(item)
+
+def skip_invalid(deposit, check):
+    ''' wraps a deposit (or prepare) callable so items with fatal problems fail up front instead of at EZID '''
+    def checked(item):
+        fatal = [p for p in check(item) if p.fatal]
+        if fatal:
+            return True, False, "skipped, invalid " + ", ".join(f"{p.field} {p.value!r}" for p in fatal)
+        return deposit(item)
+    return checked
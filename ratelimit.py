@@ -0,0 +1,156 @@
+"""
+Client side rate limiting for requests sent to EZID
+
+Limits apply per (endpoint_url, username) pair, which is how EZID accounts its load. By default each process paces
+itself with an in-memory token bucket; with EZID_RATE_LIMIT_SHARED the budget is kept in the Django cache so that
+every worker process using the same cache backend (memcached, redis, ...) shares it.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import hashlib
+import math
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+# seconds to wait before the first and longest retries of a SharedTokenBucket's lock, each wait is picked at random up
+# to the backoff so that the processes contending for the lock spread out
+LOCK_BACKOFF = 0.002
+LOCK_MAX_BACKOFF = 0.05
+
+
+class TokenBucket:
+    ''' thread safe token bucket allowing `rate` acquisitions per second with bursts of up to `burst` '''
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self.acquired = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        ''' blocks until a token is available, returns the number of seconds spent waiting '''
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    self.waited += waited
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class SharedTokenBucket:
+    ''' token bucket kept in the Django cache, allowing `rate` acquisitions per second with bursts of up to `burst`
+    across every process that shares the cache
+
+    The tokens left and the time they were counted are stored under one key and refilled on every acquisition, like
+    TokenBucket. The read and update of that state are serialized by a lock taken with the cache's atomic add, which
+    holds a token unique to its holder so that a process only ever releases its own lock.
+    '''
+    def __init__(self, rate, key, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.key = f'ezid_ratelimit_{hashlib.md5(key.encode("UTF-8")).hexdigest()}'
+        self.lock_key = f'{self.key}_lock'
+        # long enough for the bucket to refill completely, after which the state does not matter
+        self.timeout = math.ceil(self.burst / self.rate) + 1
+        self.waited = 0.0
+        self.acquired = 0
+        self._lock = threading.Lock()
+
+    def _lock_bucket(self):
+        ''' takes the lock on the bucket's state, backing off with jitter while another process holds it, and returns
+        the token to release it with '''
+        token = uuid.uuid4().hex
+        backoff = LOCK_BACKOFF
+        # a lock left behind by a process that died holding it expires after a second
+        while not cache.add(self.lock_key, token, timeout=1):
+            time.sleep(random.uniform(0, backoff))
+            backoff = min(backoff * 2, LOCK_MAX_BACKOFF)
+        return token
+
+    def _unlock_bucket(self, token):
+        # a lock that expired while held may have been taken by another process since
+        if cache.get(self.lock_key) == token:
+            cache.delete(self.lock_key)
+
+    def _take(self):
+        ''' takes a token if one is available, returns the seconds until one will be otherwise '''
+        lock = self._lock_bucket()
+        try:
+            now = time.time()
+            tokens, updated = cache.get(self.key) or (self.burst, now)
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+            if tokens >= 1:
+                cache.set(self.key, (tokens - 1, now), timeout=self.timeout)
+                return 0
+            cache.set(self.key, (tokens, now), timeout=self.timeout)
+            return (1 - tokens) / self.rate
+        finally:
+            self._unlock_bucket(lock)
+
+    def acquire(self):
+        ''' blocks until a token is available, returns the number of seconds spent waiting '''
+        waited = 0.0
+        while True:
+            delay = self._take()
+            if not delay:
+                with self._lock:
+                    self.acquired += 1
+                    self.waited += waited
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+
+_max_rps = getattr(settings, 'EZID_MAX_RPS', None)
+_shared = getattr(settings, 'EZID_RATE_LIMIT_SHARED', False)
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def configure(max_rps, shared=None):
+    ''' sets the requests per second allowed for each EZID account from now on, None for no limit '''
+    global _max_rps, _shared
+    with _limiters_lock:
+        _max_rps = max_rps
+        if shared is not None:
+            _shared = shared
+        _limiters.clear()
+
+def get_limiter(endpoint_url, username):
+    ''' returns the rate limiter for an EZID account, or None when requests are not limited '''
+    if not _max_rps:
+        return None
+    key = (endpoint_url, username)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            if _shared:
+                limiter = SharedTokenBucket(_max_rps, f'{endpoint_url} {username}')
+            else:
+                limiter = TokenBucket(_max_rps)
+            _limiters[key] = limiter
+        return limiter
+
+def wait_stats():
+    ''' returns (requests paced, total seconds spent waiting for a token) across every limiter in this process '''
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return sum(l.acquired for l in limiters), sum(l.waited for l in limiters)
@@ -0,0 +1,106 @@
+"""
+Drift detection between Janeway and the DOI records held by EZID, for the EZID plugin for Janeway
+
+For each item the record EZID holds (GET id/doi:...) is compared with the request an update would send now: the
+_target, and the Crossref metadata once both are canonicalized and stripped of the elements EZID or the render
+time fill in. Remote records are kept in the Django cache for EZID_RECONCILE_TTL seconds so a report can be re-run,
+or followed by an update of the drifted items, without reading everything from EZID again.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import hashlib
+import re
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.core.cache import cache
+
+from plugins.ezid import logic
+
+REMOTE_TTL = getattr(settings, 'EZID_RECONCILE_TTL', 3600)
+
+# elements EZID or the time of rendering fill in, which say nothing about drift; posted_content.xml falls back
+# to the day of rendering for the acceptance_date of preprints that were never accepted
+_RE_UNCOMPARED_ELEMENTS = re.compile(r"<(head|timestamp|doi_batch_id|posted_date|acceptance_date)>.*?</\1>", re.S)
+_RE_PERCENT_ESCAPE = re.compile(r"%([0-9A-Fa-f]{2})")
+_RE_TAG_WHITESPACE = re.compile(r"\s*(<[^>]*>)\s*")
+
+def parse_anvl(text):
+    ''' parses an EZID response or request body into a dict, undoing the percent escaping of values '''
+    record = {}
+    for line in text.splitlines():
+        name, sep, value = line.partition(":")
+        if sep:
+            record[name.strip()] = _RE_PERCENT_ESCAPE.sub(lambda m: chr(int(m.group(1), 16)), value.strip())
+    return record
+
+def normalize_metadata(xml):
+    ''' canonical form of a Crossref deposit for comparison, ignoring whitespace, attribute order and render time '''
+    xml = _RE_UNCOMPARED_ELEMENTS.sub("", xml or "").strip()
+    xml = re.sub(r"^<\?xml[^>]*\?>", "", xml).strip()
+    try:
+        return ElementTree.canonicalize(xml, strip_text=True)
+    except (ElementTree.ParseError, AttributeError):
+        # AttributeError on Pythons before 3.8, which lack canonicalize
+        return _RE_TAG_WHITESPACE.sub(r"\1", xml)
+
+def compare(payload, remote):
+    ''' returns the reasons the record EZID returned differs from the payload an update would send '''
+    remote_record = parse_anvl(remote)
+    if "success" not in remote_record:
+        return [f"unreadable: {remote.strip()}"]
+    local_record = parse_anvl(payload)
+    reasons = []
+    if local_record.get("_target") != remote_record.get("_target"):
+        reasons.append(f"target: {remote_record.get('_target')} != {local_record.get('_target')}")
+    if normalize_metadata(local_record.get("crossref")) != normalize_metadata(remote_record.get("crossref")):
+        reasons.append("metadata")
+    return reasons
+
+def _cache_key(deposit):
+    return 'ezid_remote_' + hashlib.md5(f'{deposit.endpoint_url} {deposit.path}'.encode("UTF-8")).hexdigest()
+
+def fetch_remote(deposit, refresh=False):
+    ''' returns the record EZID holds for the Deposit's identifier, from the cache unless refresh '''
+    key = _cache_key(deposit)
+    remote = None if refresh else cache.get(key)
+    if remote is None:
+        remote = logic.send_request("GET", deposit.path, None, deposit.username, deposit.password, deposit.endpoint_url)
+        if remote.startswith("success:"):
+            cache.set(key, str(remote), REMOTE_TTL)
+    return remote
+
+def forget_remote(deposit):
+    ''' drops the cached record of the Deposit's identifier, once it has been changed at EZID '''
+    cache.delete(_cache_key(deposit))
+
+def update(deposit, prepare, item):
+    ''' sends the update of item with deposit, forgetting the record cached for it when EZID accepts the update
+
+    deposit is logic.update_preprint_doi or logic.update_journal_doi and prepare the callable given to check.
+    '''
+    enabled, success, msg = deposit(item)
+    if success:
+        prepared = prepare(item)
+        if isinstance(prepared, logic.Deposit):
+            forget_remote(prepared)
+    return enabled, success, msg
+
+def check(prepare, item, refresh=False):
+    ''' returns (enabled, in_sync, msg) for item, msg listing the reasons when it has drifted
+
+    prepare is logic.preprint_deposit or logic.journal_deposit, with action="update" and force=True bound.
+    '''
+    deposit = prepare(item)
+    if not isinstance(deposit, logic.Deposit):
+        enabled, success, msg = deposit
+        return False, False, msg
+    remote = fetch_remote(deposit, refresh)
+    if not remote.startswith("success:"):
+        return True, False, f"missing: {remote.strip()}"
+    reasons = compare(deposit.payload, remote)
+    return True, not reasons, ", ".join(reasons) or "in sync"
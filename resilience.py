@@ -0,0 +1,199 @@
+"""
+Retries and circuit breaking for requests sent to EZID
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import asyncio
+import http.client
+import random
+import threading
+import time
+from urllib.error import URLError
+
+from django.conf import settings
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+RETRY_ATTEMPTS = getattr(settings, 'EZID_RETRY_ATTEMPTS', 4)
+RETRY_BACKOFF = getattr(settings, 'EZID_RETRY_BACKOFF', 0.5)
+RETRY_MAX_BACKOFF = getattr(settings, 'EZID_RETRY_MAX_BACKOFF', 8)
+RETRY_DEADLINE = getattr(settings, 'EZID_RETRY_DEADLINE', 60)
+BREAKER_THRESHOLD = getattr(settings, 'EZID_BREAKER_THRESHOLD', 5)
+BREAKER_RESET = getattr(settings, 'EZID_BREAKER_RESET', 30)
+
+# responses from EZID worth another attempt
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# responses that guarantee the request was not acted on, the only ones a non-idempotent mint may retry
+REJECTED_STATUSES = (429, 503)
+
+
+class CircuitOpenError(Exception):
+    ''' raised instead of calling EZID while the endpoint's circuit breaker is open '''
+
+
+class RetryPolicy:
+    def __init__(self, attempts=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF, max_backoff=RETRY_MAX_BACKOFF, deadline=RETRY_DEADLINE):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+
+    def delay(self, attempt):
+        ''' full jitter exponential backoff before retry number attempt (starting at 1) '''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    ''' opens after threshold consecutive failures, then lets a single trial call through every reset seconds '''
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if not self._trial and time.monotonic() - self.opened_at >= self.reset:
+                self._trial = True
+                return True
+        raise CircuitOpenError(f'EZID unavailable, not retrying for {self.reset} seconds after {self.failures} consecutive failures')
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+    def abandon(self):
+        ''' ends a trial call that neither succeeded nor failed, e.g. it raised a bug or was cancelled, so the next
+        trial is let through after another reset seconds instead of never '''
+        with self._lock:
+            if self._trial:
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(endpoint_url):
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint_url)
+        if breaker is None:
+            breaker = _breakers[endpoint_url] = CircuitBreaker()
+        return breaker
+
+def reset_breakers():
+    ''' forgets the state of every circuit breaker, e.g. between benchmark runs '''
+    with _breakers_lock:
+        _breakers.clear()
+
+def is_network_error(error):
+    return isinstance(error, (URLError, http.client.HTTPException, OSError))
+
+def classify(response, error, idempotent):
+    ''' returns (failed, retryable) for the outcome of one attempt '''
+    if error is not None:
+        return True, idempotent or isinstance(getattr(error, 'reason', error), ConnectionRefusedError)
+    status = getattr(response, 'status', None)
+    if status not in RETRY_STATUSES:
+        return False, False
+    return True, idempotent or status in REJECTED_STATUSES
+
+def retry_delay(attempt, retryable, policy, deadline):
+    ''' seconds to wait before the next attempt, or None when the failed attempt was the last one '''
+    delay = policy.delay(attempt)
+    if not retryable or attempt >= policy.attempts or time.monotonic() + delay > deadline:
+        return None
+    return delay
+
+def _log_retry(attempt, response, error, delay):
+    reason = repr(error) if error else f'HTTP {response.status}'
+    logger.warning(f'EZID attempt {attempt} failed ({reason}), retrying in {delay:.2f}s')
+
+def call(func, breaker, idempotent=True, policy=None):
+    ''' calls func(), retrying network errors and retryable statuses with backoff until the policy runs out
+
+    func returns an EzidResponse (or any object with a `status`). Non-idempotent calls are only retried when EZID
+    cannot have acted on them, so a mint is never sent twice. Raises CircuitOpenError without calling func while the
+    breaker is open, and re-raises the last network error once the retries are exhausted.
+    '''
+    policy = policy or RetryPolicy()
+    deadline = time.monotonic() + policy.deadline
+    attempt = 0
+    while True:
+        trial = breaker.before_call()
+        attempt += 1
+        response = error = None
+        try:
+            response = func()
+        except BaseException as e:
+            if not is_network_error(e):
+                if trial:
+                    breaker.abandon()
+                raise
+            error = e
+
+        failed, retryable = classify(response, error, idempotent)
+        if not failed:
+            breaker.success()
+            return response
+        breaker.failure()
+        delay = retry_delay(attempt, retryable, policy, deadline)
+        if delay is None:
+            if error:
+                raise error
+            return response
+        _log_retry(attempt, response, error, delay)
+        time.sleep(delay)
+
+async def call_async(func, breaker, idempotent=True, policy=None):
+    ''' the coroutine version of call, func is a coroutine function '''
+    policy = policy or RetryPolicy()
+    deadline = time.monotonic() + policy.deadline
+    attempt = 0
+    while True:
+        trial = breaker.before_call()
+        attempt += 1
+        response = error = None
+        try:
+            response = await func()
+        except BaseException as e:
+            if not is_network_error(e):
+                if trial:
+                    breaker.abandon()
+                raise
+            error = e
+
+        failed, retryable = classify(response, error, idempotent)
+        if not failed:
+            breaker.success()
+            return response
+        breaker.failure()
+        delay = retry_delay(attempt, retryable, policy, deadline)
+        if delay is None:
+            if error:
+                raise error
+            return response
+        _log_retry(attempt, response, error, delay)
+        await asyncio.sleep(delay)
@@ -0,0 +1,16 @@
+"""
+Signal receivers keeping the EZID plugin's cached configuration up to date, connected by EzidConfig.ready()
+"""
+
+from django.db.models.signals import post_save, post_delete
+
+from core.models import SettingValue
+from plugins.ezid import config
+from plugins.ezid.models import RepoEZIDSettings
+
+def connect():
+    ''' connects the receivers that invalidate the cached EZID configuration, safe to call more than once '''
+    post_save.connect(config.clear_journal_configs, sender=SettingValue, dispatch_uid='ezid_setting_saved')
+    post_delete.connect(config.clear_journal_configs, sender=SettingValue, dispatch_uid='ezid_setting_deleted')
+    post_save.connect(config.clear_repo_configs, sender=RepoEZIDSettings, dispatch_uid='ezid_repo_settings_saved')
+    post_delete.connect(config.clear_repo_configs, sender=RepoEZIDSettings, dispatch_uid='ezid_repo_settings_deleted')
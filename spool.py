@@ -0,0 +1,131 @@
+"""
+Two stage deposits for the EZID plugin for Janeway
+
+export_spool renders the EZID requests for a selection into a JSONL spool file on a host with database access.
+deposit_spool streams a spool file to EZID without touching the database, appending one JSON line per request to a
+results file, and apply_results records the outcome of those requests back in the database and its audit log.
+
+Passwords are never written to the spool, the deposit stage looks them up per EZID username in the
+EZID_SPOOL_PASSWORDS setting or the environment.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import json
+import os
+import re
+import time
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from utils.logger import get_logger
+
+from plugins.ezid import bulk, logic
+from plugins.ezid.models import DepositRecord
+from plugins.ezid.transport import EzidResponse
+
+logger = get_logger(__name__)
+
+SpoolRecord = namedtuple('SpoolRecord', ['model', 'pk', 'action', 'method', 'path', 'payload', 'digest', 'username', 'endpoint_url'])
+
+def export_spool(items, prepare, spool_file):
+    ''' writes a SpoolRecord line to spool_file for every item prepare(item) returns a logic.Deposit for
+
+    prepare is logic.preprint_deposit or logic.journal_deposit with the action bound. Yields (item, result) for every
+    item, where result is None when the item was spooled and the (enabled, success, msg) result otherwise.
+    '''
+    for item in bulk.iterate(items):
+        try:
+            deposit = prepare(item)
+        except Exception as e:
+            logger.exception(f'EZID spool export failed for {item}')
+            deposit = True, False, str(e)
+        if not isinstance(deposit, logic.Deposit):
+            yield item, deposit
+            continue
+        content_type = ContentType.objects.get_for_model(item)
+        record = SpoolRecord(f'{content_type.app_label}.{content_type.model}', item.pk, deposit.action, deposit.method,
+                             deposit.path, deposit.payload, deposit.digest, deposit.username, deposit.endpoint_url)
+        spool_file.write(json.dumps(record._asdict()) + "\n")
+        yield item, None
+
+def read_spool(spool_file):
+    for line in spool_file:
+        if line.strip():
+            yield SpoolRecord(**json.loads(line))
+
+def read_succeeded(results_file):
+    ''' returns the (model, pk, action) of every request recorded as successful in a results file '''
+    succeeded = set()
+    for line in results_file:
+        if line.strip():
+            result = json.loads(line)
+            if result['success']:
+                succeeded.add((result['model'], result['pk'], result['action']))
+    return succeeded
+
+def password_variable(username):
+    ''' the environment variable holding the password of an EZID user, e.g. EZID_PASSWORD_APITEST for apitest '''
+    return 'EZID_PASSWORD_' + re.sub(r'[^A-Z0-9]', '_', username.upper())
+
+def spool_password(username):
+    ''' the password of an EZID user from the EZID_SPOOL_PASSWORDS setting or the environment, None if neither has it '''
+    return getattr(settings, 'EZID_SPOOL_PASSWORDS', {}).get(username) or os.environ.get(password_variable(username))
+
+def _send(get_password, record):
+    password = get_password(record.username)
+    if password is None:
+        return False, False, f'no password for EZID user {record.username}, set {password_variable(record.username)}'
+    started = time.monotonic()
+    ezid_result = logic.send_request(record.method, record.path, record.payload, record.username, password, record.endpoint_url)
+    return True, ezid_result.startswith('success:'), (ezid_result, time.monotonic() - started)
+
+def deposit_spool(records, results_file, get_password=spool_password, workers=bulk.DEFAULT_WORKERS, skip=frozenset()):
+    ''' sends every SpoolRecord to EZID, appending the outcome of each to results_file and yielding its DepositResult
+
+    get_password returns the password of an EZID username, or None when there is none. Records whose
+    (model, pk, action) is in skip, e.g. those already deposited according to read_succeeded, are not sent again.
+    '''
+    records = (r for r in records if (r.model, r.pk, r.action) not in skip)
+    for result in bulk.run_deposits(records, lambda record: _send(get_password, record), workers=workers):
+        record = result.item
+        if result.enabled:
+            ezid_result, latency = result.msg if isinstance(result.msg, tuple) else (result.msg, None)
+            result = result._replace(msg=ezid_result)
+            # the key identifies this request once it is applied, however often the record is sent again
+            results_file.write(json.dumps({'key': uuid.uuid4().hex, 'model': record.model, 'pk': record.pk,
+                                           'action': record.action, 'path': record.path, 'digest': record.digest,
+                                           'success': result.success,
+                                           'status': getattr(ezid_result, 'status', None), 'latency': latency,
+                                           'result': str(ezid_result)}) + "\n")
+            results_file.flush()
+        yield result
+
+def apply_results(results_file):
+    ''' records every request in a results file as logic.complete_deposit does, yielding its result
+
+    Every line carries a key that is stored on the DepositRecord it leaves, so lines applied by an earlier run are
+    skipped and a results file can be applied again after an interruption.
+    '''
+    for line in results_file:
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        app_label, model = result['model'].split('.')
+        try:
+            item = ContentType.objects.get_by_natural_key(app_label, model).get_object_for_this_type(pk=result['pk'])
+        except ObjectDoesNotExist:
+            yield bulk.DepositResult(f"{result['model']} {result['pk']}", False, False, 'no longer exists')
+            continue
+        if DepositRecord.objects.filter(spool_key=result['key']).exists():
+            yield bulk.DepositResult(item, False, result['success'], 'already applied')
+            continue
+        deposit = logic.Deposit(item, result['action'], None, result.get('path'), None, result['digest'], None, None, None)
+        ezid_result = EzidResponse(result['result'], result['status']) if result.get('status') else result['result']
+        yield bulk.DepositResult(item, *logic.complete_deposit(deposit, ezid_result, latency=result.get('latency'), spool_key=result['key']))
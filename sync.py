@@ -0,0 +1,93 @@
+"""
+Incremental "changed since" selection for the sync_ezid_doi command of the EZID plugin for Janeway
+
+Candidates are the items of a repository or journal with a modification timestamp, of their own or of a related
+author, version or licence, later than the scope's high-water mark. Only the timestamp fields that exist in the
+installed Janeway are used. The selection errs on the side of too many candidates: the update path skips any
+whose rendered metadata matches the last deposit, so only real changes reach EZID.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
+
+from utils.logger import get_logger
+
+from plugins.ezid import bulk
+from plugins.ezid.models import SyncState
+
+logger = get_logger(__name__)
+
+# timestamps whose change can alter a deposit's metadata, checked against the installed models
+PREPRINT_CHANGE_FIELDS = [
+    'date_updated',
+    'date_published',
+    'preprintversion__date_time',
+    'preprintauthor__account__last_modified',
+    'license__last_modified',
+]
+ARTICLE_CHANGE_FIELDS = [
+    'last_modified',
+    'date_published',
+    'frozenauthor__last_modified',
+    'license__last_modified',
+    'primary_issue__last_modified',
+]
+
+def has_field_path(model, path):
+    ''' True when path, e.g. "frozenauthor__last_modified", names a field reachable from model '''
+    for name in path.split('__'):
+        if model is None:
+            return False
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        model = field.related_model
+    return True
+
+_missing_warned = set()
+
+def change_fields(model, paths):
+    ''' the paths that exist on model, warning once per process about each one that does not '''
+    fields = []
+    for path in paths:
+        if has_field_path(model, path):
+            fields.append(path)
+        elif (model, path) not in _missing_warned:
+            _missing_warned.add((model, path))
+            logger.warning(f'{model._meta.label} has no field {path}, changes to it will not be picked up by sync_ezid_doi')
+    return fields
+
+def changed_since(items, paths, since):
+    ''' filters items down to those with a timestamp in paths later than since '''
+    query = Q()
+    for path in paths:
+        query |= Q(**{f'{path}__gt': since})
+    return items.filter(query).distinct()
+
+def preprint_candidates(repository, since):
+    preprints = bulk.select_preprints(short_name=repository.short_name).exclude(preprint_doi__isnull=True).exclude(preprint_doi='')
+    if since is None:
+        return preprints
+    return changed_since(preprints, change_fields(preprints.model, PREPRINT_CHANGE_FIELDS), since)
+
+def article_candidates(journal, since):
+    articles = bulk.select_articles(journal=journal).filter(identifier__id_type='doi').distinct()
+    if since is None:
+        return articles
+    return changed_since(articles, change_fields(articles.model, ARTICLE_CHANGE_FIELDS), since)
+
+def get_high_water(scope):
+    state = SyncState.objects.filter(scope_type=ContentType.objects.get_for_model(scope), scope_id=scope.pk).first()
+    return state.high_water if state else None
+
+def set_high_water(scope, high_water):
+    SyncState.objects.update_or_create(scope_type=ContentType.objects.get_for_model(scope),
+                                       scope_id=scope.pk,
+                                       defaults={'high_water': high_water})
@@ -1,4 +1,6 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.core.management import call_command
 from django.template.loader import render_to_string
 
@@ -6,11 +8,26 @@ from utils.testing import helpers
 from utils import setting_handler, logger
 
 import plugins.ezid.logic as logic
-
-from plugins.ezid.models import RepoEZIDSettings
-from repository.models import Repository
-
-from datetime import datetime
+from plugins.ezid import async_bulk, audit, bulk, export, metrics, preflight, ratelimit, reconcile, resilience, spool, sync, transport, validation
+from plugins.ezid.management.commands._fakeezid import FakeEzidServer
+from plugins.ezid.management.commands import benchmark_ezid
+
+from plugins.ezid.models import RepoEZIDSettings, QueuedDeposit, BulkRun, DepositRecord
+from repository.models import Repository, Preprint
+
+import asyncio
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.error import URLError
+from xml.etree import ElementTree
 from django.utils import timezone
 
 import mock
@@ -18,10 +35,29 @@ from django.core.cache import cache
 from freezegun import freeze_time
 
 from identifiers.models import Identifier
-from submission.models import Licence
+from submission.models import Licence, Article
 
 FROZEN_DATETIME = timezone.make_aware(timezone.datetime(2023, 1, 1, 0, 0, 0))
 
+# stands in for crossref5.3.1.xsd, which is not shipped: a doi_batch must hold a head and a body
+TEST_SCHEMA = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:cr="http://www.crossref.org/schema/5.3.1"
+           targetNamespace="http://www.crossref.org/schema/5.3.1" elementFormDefault="qualified">
+  <xs:complexType name="anything">
+    <xs:sequence><xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/></xs:sequence>
+  </xs:complexType>
+  <xs:element name="doi_batch">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="head" type="cr:anything"/>
+        <xs:element name="body" type="cr:anything"/>
+      </xs:sequence>
+      <xs:anyAttribute processContents="skip"/>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
 class EZIDJournalTest(TestCase):
     def setUp(self):
         call_command('install_plugins', 'ezid')
@@ -48,6 +84,36 @@ class EZIDJournalTest(TestCase):
         self.assertEqual(metadata["depositor_email"], "user1@test.edu")
         self.assertEqual(metadata["registrant"], "crossref_registrant")
 
+    def test_journal_config_cached(self):
+        with mock.patch.object(setting_handler, 'get_setting', wraps=setting_handler.get_setting) as get_setting:
+            logic.get_journal_metadata(self.article)
+            logic.get_journal_metadata(self.article)
+            logic.get_journal_template(self.journal)
+            self.assertEqual(get_setting.call_count, 8)
+
+        setting_handler.save_setting('Identifiers', 'crossref_name', self.journal, "crossref_changed")
+        metadata = logic.get_journal_metadata(self.article)
+        self.assertEqual(metadata["depositor_name"], "crossref_changed")
+
+    def test_journal_metadata_queries(self):
+        def count_queries(articles):
+            with CaptureQueriesContext(connection) as context:
+                [logic.get_journal_metadata(a) for a in logic.prefetch_journal_metadata(articles)]
+            return len(context.captured_queries)
+
+        # the first call loads the journal settings into the caches
+        count_queries(Article.objects.filter(pk=self.article.pk))
+        single = count_queries(Article.objects.filter(pk=self.article.pk))
+        for _ in range(3):
+            helpers.create_article(self.journal)
+        self.assertEqual(count_queries(Article.objects.filter(journal=self.journal)), single)
+
+    def test_journal_template_without_orm(self):
+        metadata = logic.get_journal_metadata(self.article)
+        with self.assertNumQueries(0):
+            logic.prepare_payload(metadata, 'ezid/journal_content.xml', metadata["target_url"], "owner")
+            logic.prepare_payload(metadata, 'ezid/book_chapter.xml', metadata["target_url"], "owner")
+
     def test_journal_percent(self):
         self.article.title = "This is the title with a %"
         self.article.save()
@@ -246,6 +312,70 @@ class EZIDJournalTest(TestCase):
         self.assertTrue(success)
         self.assertEqual(msg, "success: doi:10.9999/TEST | ark:/b9999/test")
 
+    @mock.patch('plugins.ezid.logic.send_request', return_value="success: doi:10.9999/TEST | ark:/b9999/test")
+    def test_preflight(self, mock_send):
+        Identifier.objects.create(id_type="doi", identifier="not a doi", article=self.article)
+        self.article.remote_url = None
+        self.article.save()
+
+        problems = list(preflight.scan(bulk.select_articles(journal=self.journal), preflight.article_problems, chunk_size=1))
+        self.assertEqual({p.field for p in problems}, {"issn", "remote_url", "doi"})
+        self.assertTrue(all(p.fatal and p.item == self.article for p in problems))
+
+        deposit = preflight.skip_invalid(logic.update_journal_doi, preflight.article_problems)
+        enabled, success, msg = deposit(self.article)
+        self.assertFalse(success)
+        self.assertTrue(msg.startswith("skipped, invalid issn"))
+        mock_send.assert_not_called()
+
+        setting_handler.save_setting('general', 'journal_issn', self.journal, "1111-1111")
+        cache.clear()
+        Identifier.objects.filter(article=self.article).update(identifier="10.9999/TEST")
+        self.article.remote_url = "https://test.org/qtXXXXXX"
+        self.article.save()
+        self.assertEqual(preflight.article_problems(self.article), [])
+
+    @mock.patch('plugins.ezid.logic.send_request')
+    def test_dry_run(self, mock_send):
+        setting_handler.save_setting('general', 'journal_issn', self.journal, "1111-1111")
+        cache.clear()
+        Identifier.objects.create(id_type="doi", identifier="10.9999/TEST", article=self.article)
+        prepare = lambda article: logic.journal_deposit(article, "register")
+
+        with mock.patch.object(validation, 'SCHEMA_DIR', os.path.join(tempfile.gettempdir(), 'no_schemas')):
+            validation.get_schema.cache_clear()
+            results = list(validation.dry_run(bulk.select_articles(journal=self.journal), prepare))
+        validation.get_schema.cache_clear()
+        self.assertEqual([r[1:] for r in results], [(True, True, validation.WELL_FORMED_ONLY)])
+        mock_send.assert_not_called()
+
+        payload = prepare(self.article).payload
+        self.assertEqual(validation.validate_payload(payload), [])
+        violations = validation.validate_payload(payload.replace("</titles>", ""))
+        self.assertEqual(len(violations), 1)
+        self.assertTrue(violations[0].startswith("not well formed"))
+
+    @unittest.skipIf(validation.etree is None, "schema validation needs lxml")
+    def test_dry_run_schema(self):
+        setting_handler.save_setting('general', 'journal_issn', self.journal, "1111-1111")
+        cache.clear()
+        Identifier.objects.create(id_type="doi", identifier="10.9999/TEST", article=self.article)
+        payload = logic.journal_deposit(self.article, "register").payload
+        with tempfile.TemporaryDirectory() as schema_dir:
+            with open(os.path.join(schema_dir, 'crossref5.3.1.xsd'), 'w', encoding='UTF-8') as xsd:
+                xsd.write(TEST_SCHEMA)
+            with mock.patch.object(validation, 'SCHEMA_DIR', schema_dir):
+                validation.get_schema.cache_clear()
+                try:
+                    results = list(validation.dry_run(bulk.select_articles(journal=self.journal), lambda article: logic.journal_deposit(article, "register")))
+                    violations = validation.validate_payload(payload.replace("<head>", "<header>").replace("</head>", "</header>"))
+                finally:
+                    validation.get_schema.cache_clear()
+        self.assertEqual([r[1:] for r in results], [(True, True, "valid")])
+        self.assertEqual(len(violations), 1)
+        self.assertTrue(violations[0].startswith("line "))
+        self.assertIn("header", violations[0])
+
 class EZIDPreprintTest(TestCase):
     def setUp(self):
         call_command('install_plugins', 'ezid')
@@ -270,6 +400,47 @@ class EZIDPreprintTest(TestCase):
         self.assertEqual(metadata["group_title"], self.subject.name)
         self.assertEqual(len(metadata["contributors"]), 1)
 
+    def test_digest_stable_without_accepted_date(self):
+        self.preprint.preprint_doi = "10.9999/TEST"
+        self.preprint.date_accepted = None
+        self.preprint.date_published = FROZEN_DATETIME - timedelta(days=7)
+        self.preprint.save()
+        digests = []
+        for day in (FROZEN_DATETIME, FROZEN_DATETIME + timedelta(days=1)):
+            with freeze_time(day):
+                digests.append(logic.payload_digest(logic.preprint_deposit(self.preprint, "update", force=True).payload))
+        self.assertEqual(digests[0], digests[1])
+
+    def test_repo_config_cached(self):
+        self.assertEqual(logic.get_repo_config(self.repo).ezid_owner, "owner")
+        with self.assertNumQueries(0):
+            self.assertEqual(logic.get_repo_config(self.repo).ezid_owner, "owner")
+
+        s = RepoEZIDSettings.objects.get(repo=self.repo)
+        s.ezid_owner = "new_owner"
+        s.save()
+        self.assertEqual(logic.get_repo_config(self.repo).ezid_owner, "new_owner")
+
+        s.delete()
+        self.assertIsNone(logic.get_repo_config(self.repo))
+
+    def test_preprint_metadata_queries(self):
+        def count_queries(preprints):
+            with CaptureQueriesContext(connection) as context:
+                metadata = [logic.get_preprint_metadata(p) for p in logic.prefetch_preprint_metadata(preprints)]
+            self.assertTrue(all(m["group_title"] == self.subject.name for m in metadata))
+            return len(context.captured_queries)
+
+        single = count_queries(Preprint.objects.filter(pk=self.preprint.pk))
+        for _ in range(3):
+            helpers.create_preprint(self.repo, self.user, self.subject)
+        self.assertEqual(count_queries(Preprint.objects.filter(repository=self.repo)), single)
+
+    def test_prefetched_preprint_metadata(self):
+        preprint = logic.prefetch_preprint_metadata(Preprint.objects.filter(pk=self.preprint.pk)).get()
+        self.assertEqual(logic.get_preprint_metadata(preprint)["contributors"], logic.get_preprint_metadata(self.preprint)["contributors"])
+        self.assertEqual(logic.get_preprint_metadata(preprint)["download_url"], logic.get_preprint_metadata(self.preprint)["download_url"])
+
     def test_preprint_percent(self):
         self.preprint.title = "This is the title with a %"
         self.preprint.save()
@@ -315,6 +486,17 @@ class EZIDPreprintTest(TestCase):
         self.assertIn(self.preprint.abstract, cref_xml)
         self.assertIn("10.50505/preprint_sample_doi_2", cref_xml)
 
+    def test_minified_payload(self):
+        metadata = logic.get_preprint_metadata(self.preprint)
+        metadata['now'] = datetime(2023, 1, 1)
+        metadata['abstract'] = "An abstract\n\n   spread   over lines"
+        metadata['update_id'] = "10.9999/TEST"
+
+        rendered = re.sub(r"\s+", " ", render_to_string('ezid/posted_content.xml', metadata)).strip()
+        payload = logic.prepare_payload(metadata, 'ezid/posted_content.xml', "https://test.org", "owner")
+
+        self.assertEqual(payload, f"crossref: {rendered}\n_crossref: yes\n_profile: crossref\n_target: https://test.org\n_owner: owner")
+
     def test_update_no_doi(self):
         enabled, success, msg = logic.update_preprint_doi(self.preprint)
 
@@ -381,3 +563,576 @@ class EZIDPreprintTest(TestCase):
         self.assertTrue(success)
         self.assertEqual(msg, "success: doi:10.9999/TEST | ark:/b9999/test")
         self.assertEqual(self.preprint.preprint_doi, "10.9999/TEST")
+
+    @freeze_time(FROZEN_DATETIME)
+    @mock.patch('plugins.ezid.logic.send_request', return_value="success: doi:10.9999/TEST | ark:/b9999/test")
+    def test_preprint_update_unchanged(self, mock_send):
+        self.preprint.preprint_doi = "10.9999/TEST"
+
+        logic.update_preprint_doi(self.preprint)
+        enabled, success, msg = logic.update_preprint_doi(self.preprint)
+
+        mock_send.assert_called_once()
+        self.assertTrue(enabled)
+        self.assertTrue(success)
+        self.assertEqual(msg, f'{self.preprint} unchanged since the last EZID deposit, skipped')
+
+        logic.update_preprint_doi(self.preprint, force=True)
+        self.assertEqual(mock_send.call_count, 2)
+
+        self.preprint.title = "This is a changed title"
+        logic.update_preprint_doi(self.preprint)
+        self.assertEqual(mock_send.call_count, 3)
+
+    def test_payload_digest(self):
+        payload = 'crossref: <doi_batch> <head> <doi_batch_id>JournalOne_20230101_7</doi_batch_id> <timestamp>1672531200</timestamp> </head> <title>T</title> </doi_batch>'
+        later = 'crossref: <doi_batch> <head> <doi_batch_id>JournalOne_20230102_7</doi_batch_id> <timestamp>1672617600</timestamp> </head> <title>T</title> </doi_batch>'
+        self.assertEqual(logic.payload_digest(payload), logic.payload_digest(later))
+        self.assertNotEqual(logic.payload_digest(payload), logic.payload_digest(payload.replace("<title>T", "<title>U")))
+
+    def test_publication_queues_mint(self):
+        logic.preprint_publication(preprint=self.preprint, request=None)
+
+        queued = QueuedDeposit.objects.get()
+        self.assertEqual(queued.item, self.preprint)
+        self.assertEqual(queued.action, "mint")
+        self.assertEqual(queued.status, QueuedDeposit.PENDING)
+
+    @freeze_time(FROZEN_DATETIME)
+    @mock.patch('plugins.ezid.logic.send_request', return_value="success: doi:10.9999/TEST | ark:/b9999/test")
+    def test_process_queued_mint(self, mock_send):
+        queued = logic.enqueue_deposit(self.preprint, "mint")
+
+        claimed = logic.claim_queued_deposits(10)
+        self.assertEqual(claimed, [queued])
+        self.assertEqual(logic.claim_queued_deposits(10), [])
+
+        enabled, success, msg = logic.process_queued_deposit(claimed[0])
+
+        self.assertTrue(success)
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, QueuedDeposit.DONE)
+        self.assertEqual(queued.attempts, 1)
+        self.assertEqual(queued.result, "success: doi:10.9999/TEST | ark:/b9999/test")
+        self.preprint.refresh_from_db()
+        self.assertEqual(self.preprint.preprint_doi, "10.9999/TEST")
+
+    @freeze_time(FROZEN_DATETIME)
+    @mock.patch('plugins.ezid.logic.send_request', return_value=transport.EzidResponse("success: doi:10.9999/TEST | ark:/b9999/test", 201))
+    def test_deposit_record(self, mock_send):
+        logic.mint_preprint_doi(self.preprint)
+
+        record = DepositRecord.objects.get()
+        self.assertEqual(record.item, self.preprint)
+        self.assertEqual((record.action, record.doi, record.success, record.status), ("mint", "10.9999/TEST", True, 201))
+        self.assertIsNotNone(record.latency)
+        self.assertEqual(len(record.digest), 64)
+
+        mock_send.return_value = transport.EzidResponse("error: bad request - no such identifier\n", 400)
+        with audit.buffered():
+            logic.update_preprint_doi(self.preprint, force=True)
+            self.assertEqual(DepositRecord.objects.count(), 1)
+        failed = DepositRecord.objects.filter(success=False).get()
+        self.assertEqual((failed.action, failed.doi, failed.status), ("update", "10.9999/TEST", 400))
+
+    @freeze_time(FROZEN_DATETIME)
+    @mock.patch('plugins.ezid.logic.send_request', return_value="success: doi:10.9999/TEST | ark:/b9999/test")
+    def test_deposit_metrics(self, mock_send):
+        sink = metrics.PrometheusSink()
+        metrics.configure(sink)
+        try:
+            logic.mint_preprint_doi(self.preprint)
+        finally:
+            metrics.configure(None)
+
+        spans = {dict(labels)['span'] for name, labels in sink.histograms}
+        self.assertEqual(spans, {'get_config', 'get_metadata', 'prepare_payload', 'process_ezid_result'})
+        self.assertIn('ezid_deposits_total{action="mint",outcome="success"} 1\n', sink.render())
+
+    def test_sync_candidates(self):
+        self.preprint.preprint_doi = "10.9999/TEST"
+        self.preprint.date_published = timezone.now() - timedelta(days=2)
+        self.preprint.save()
+
+        self.assertTrue(sync.has_field_path(Preprint, 'date_published'))
+        self.assertFalse(sync.has_field_path(Preprint, 'no_such_field__last_modified'))
+        with mock.patch.object(sync, 'logger') as mock_logger:
+            self.assertEqual(sync.change_fields(Preprint, ['date_published', 'no_such_field']), ['date_published'])
+            sync.change_fields(Preprint, ['no_such_field'])
+        mock_logger.warning.assert_called_once()
+        self.assertIn('no_such_field', mock_logger.warning.call_args[0][0])
+        self.assertEqual(list(sync.preprint_candidates(self.repo, None)), [self.preprint])
+        self.assertEqual(list(sync.preprint_candidates(self.repo, timezone.now() - timedelta(days=3))), [self.preprint])
+        self.assertEqual(list(sync.preprint_candidates(self.repo, timezone.now() + timedelta(minutes=1))), [])
+
+        self.assertIsNone(sync.get_high_water(self.repo))
+        sync.set_high_water(self.repo, FROZEN_DATETIME)
+        self.assertEqual(sync.get_high_water(self.repo), FROZEN_DATETIME)
+
+    def test_checkpoint_resume(self):
+        checkpoint = bulk.Checkpoint.start('bulk_ezid_doi', 'update', {'repository': self.repo.short_name})
+        pk = self.preprint.pk
+        for item_pk in (pk - 2, pk - 1, pk, pk + 1):
+            checkpoint.progress.submit(item_pk)
+        for item_pk, success in ((pk - 2, True), (pk - 1, False), (pk + 1, True)):
+            checkpoint.progress.done(item_pk)
+            checkpoint.record(bulk.DepositResult(mock.Mock(pk=item_pk), True, success, ""))
+        checkpoint.save()
+
+        run = BulkRun.objects.get()
+        self.assertEqual((run.last_pk, run.done_pks, run.failures), (pk - 1, f"[{pk + 1}]", f"[{pk - 1}]"))
+        self.assertEqual((run.processed, run.succeeded, run.finished), (3, 2, False))
+        resumed = bulk.Checkpoint(run)
+        self.assertEqual(list(resumed.remaining(Preprint.objects.all())), [self.preprint])
+        # the done pks move the start of the selection instead of being excluded by every chunk
+        self.assertNotIn("NOT", str(resumed.remaining(Preprint.objects.all()).query))
+
+        resumed.progress.submit(pk)
+        resumed.progress.done(pk)
+        resumed.record(bulk.DepositResult(self.preprint, True, True, ""))
+        resumed.save(finished=True)
+        run.refresh_from_db()
+        self.assertEqual((run.last_pk, run.done_pks, run.finished), (pk, f"[{pk + 1}]", True))
+
+    def test_checkpoint_retry_failed(self):
+        checkpoint = bulk.Checkpoint.start('bulk_ezid_doi', 'update', {'repository': self.repo.short_name})
+        checkpoint.progress.submit(self.preprint.pk)
+        checkpoint.progress.done(self.preprint.pk)
+        checkpoint.record(bulk.DepositResult(self.preprint, True, False, "error: bad request"))
+        checkpoint.save(finished=True)
+
+        resumed = bulk.Checkpoint(BulkRun.objects.get())
+        self.assertEqual(list(resumed.remaining(Preprint.objects.all())), [])
+        self.assertEqual(list(resumed.remaining(Preprint.objects.all(), retry_failed=True)), [self.preprint])
+
+    def test_checkpoint_retry_failed_interrupted(self):
+        failed, done = self.preprint, helpers.create_preprint(self.repo, self.user, self.subject)
+        checkpoint = bulk.Checkpoint.start('bulk_ezid_doi', 'update', {'repository': self.repo.short_name})
+        for preprint, success in ((failed, False), (done, True)):
+            checkpoint.progress.submit(preprint.pk)
+            checkpoint.progress.done(preprint.pk)
+            checkpoint.record(bulk.DepositResult(preprint, True, success, ""))
+        checkpoint.save()
+
+        # the retried failure fails again and the run is interrupted
+        resumed = bulk.Checkpoint(BulkRun.objects.get())
+        self.assertEqual(list(resumed.remaining(Preprint.objects.all(), retry_failed=True)), [failed])
+        resumed.progress.submit(failed.pk)
+        resumed.progress.done(failed.pk)
+        resumed.record(bulk.DepositResult(failed, True, False, ""))
+        resumed.save()
+
+        run = BulkRun.objects.get()
+        self.assertEqual((run.last_pk, run.failures), (done.pk, f"[{failed.pk}]"))
+        resumed = bulk.Checkpoint(run)
+        self.assertEqual(list(resumed.remaining(Preprint.objects.all())), [])
+        self.assertEqual(list(resumed.remaining(Preprint.objects.all(), retry_failed=True)), [failed])
+
+    @freeze_time(FROZEN_DATETIME)
+    @mock.patch('plugins.ezid.logic.send_request', return_value="success: doi:10.9999/TEST | ark:/b9999/test")
+    def test_spool_round_trip(self, mock_send):
+        spool_file, results_file = io.StringIO(), io.StringIO()
+        prepare = lambda preprint: logic.preprint_deposit(preprint, "mint")
+        self.assertEqual(list(spool.export_spool([self.preprint], prepare, spool_file)), [(self.preprint, None)])
+        self.assertNotIn("password", spool_file.getvalue())
+
+        spool_file.seek(0)
+        results = list(spool.deposit_spool(spool.read_spool(spool_file), results_file, {"username": "password"}.get))
+        self.assertTrue(results[0].success)
+        mock_send.assert_called_once_with("POST", "shoulder/shoulder", mock.ANY, "username", "password", "endpoint.org")
+
+        results_file.seek(0)
+        self.assertEqual(spool.read_succeeded(results_file), {("repository.preprint", self.preprint.pk, "mint")})
+        results_file.seek(0)
+        enabled, success, msg = list(spool.apply_results(results_file))[0][1:]
+        self.assertTrue(success)
+        self.assertEqual(DepositRecord.objects.get().spool_key, json.loads(results_file.getvalue())["key"])
+        self.preprint.refresh_from_db()
+        self.assertEqual(self.preprint.preprint_doi, "10.9999/TEST")
+
+        # applying the same results again records nothing new
+        results_file.seek(0)
+        self.assertEqual(list(spool.apply_results(results_file))[0][1:], (False, True, "already applied"))
+        self.assertEqual(DepositRecord.objects.count(), 1)
+
+    def test_spool_passwords(self):
+        with self.settings(EZID_SPOOL_PASSWORDS={"username": "from settings"}), \
+                mock.patch.dict(os.environ, {"EZID_PASSWORD_OTHER_USER": "from env"}):
+            self.assertEqual(spool.spool_password("username"), "from settings")
+            self.assertEqual(spool.spool_password("other-user"), "from env")
+            self.assertIsNone(spool.spool_password("unknown"))
+
+    @mock.patch('plugins.ezid.logic.send_request')
+    def test_reconcile(self, mock_send):
+        self.preprint.preprint_doi = "10.9999/TEST"
+        self.preprint.save()
+        prepare = lambda preprint: logic.preprint_deposit(preprint, "update", force=True)
+        with freeze_time(FROZEN_DATETIME - timedelta(days=1)):
+            payload = prepare(self.preprint).payload
+        remote = "success: doi:10.9999/TEST\n" + payload.replace("> <", ">%0A  <") + "\n_status: public"
+        mock_send.return_value = transport.EzidResponse(remote, 200)
+
+        self.assertEqual(reconcile.check(prepare, self.preprint, refresh=True), (True, True, "in sync"))
+        mock_send.assert_called_once_with("GET", "id/doi:10.9999/TEST", None, "username", "password", "endpoint.org")
+        self.assertEqual(reconcile.check(prepare, self.preprint), (True, True, "in sync"))
+        self.assertEqual(mock_send.call_count, 1)
+
+        mock_send.return_value = transport.EzidResponse(remote.replace("_target: ", "_target: https://old.org/"), 200)
+        enabled, in_sync, msg = reconcile.check(prepare, self.preprint, refresh=True)
+        self.assertFalse(in_sync)
+        self.assertTrue(msg.startswith("target: https://old.org/"))
+
+        mock_send.return_value = transport.EzidResponse(remote.replace("</title>", " (draft)</title>"), 200)
+        self.assertEqual(reconcile.check(prepare, self.preprint, refresh=True), (True, False, "metadata"))
+
+        mock_send.return_value = transport.EzidResponse("error: bad request - no such identifier\n", 400)
+        self.assertEqual(reconcile.check(prepare, self.preprint, refresh=True), (True, False, "missing: error: bad request - no such identifier"))
+
+        mock_send.return_value = transport.EzidResponse(remote, 200)
+        reconcile.check(prepare, self.preprint, refresh=True)
+        key = reconcile._cache_key(prepare(self.preprint))
+        self.assertIsNotNone(cache.get(key))
+        self.assertEqual(reconcile.update(lambda preprint: (True, True, "updated"), prepare, self.preprint), (True, True, "updated"))
+        self.assertIsNone(cache.get(key))
+
+    @mock.patch('plugins.ezid.logic.send_request', return_value="success: doi:10.9999/TEST | ark:/b9999/test")
+    def test_chunked_iteration(self, mock_send):
+        published = timezone.now() - timedelta(days=1)
+        preprints = [self.preprint] + [helpers.create_preprint(self.repo, self.user, self.subject) for _ in range(4)]
+        for preprint in preprints:
+            preprint.date_published = published
+            preprint.save()
+        selection = bulk.select_preprints(short_name=self.repo.short_name)
+
+        chunks = list(bulk.in_chunks(selection, 2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual([p for chunk in chunks for p in chunk], preprints)
+        self.assertEqual(list(bulk.iterate(selection, 3)), preprints)
+        self.assertEqual(list(bulk.iterate(selection.order_by('-pk'), 2)), preprints)
+
+        preprint = selection.first()
+        logic.mint_preprint_doi(preprint)
+        item = bulk.compact(preprint)
+        self.assertIsInstance(item, bulk.DepositItem)
+        self.assertEqual((item.model, item.pk, item.doi), ("repository.preprint", self.preprint.pk, "10.9999/TEST"))
+        self.assertEqual(str(item), str(self.preprint))
+        self.assertEqual(item, self.preprint)
+        self.assertFalse(hasattr(item, '__dict__'))
+        self.assertEqual(bulk.compact(3), 3)
+
+    def test_export_xml(self):
+        self.preprint.preprint_doi = "10.9999/TEST"
+        self.preprint.date_published = timezone.now() - timedelta(days=1)
+        self.preprint.save()
+        other = helpers.create_preprint(self.repo, self.user, self.subject)
+        other.date_published = self.preprint.date_published
+        other.save()
+        prepare = lambda preprint: logic.preprint_deposit(preprint, "update", force=True)
+
+        out = io.StringIO()
+        results = list(export.write_export(bulk.select_preprints(short_name=self.repo.short_name), prepare, out, chunk_size=1))
+        self.assertEqual(results[0], (self.preprint, None))
+        self.assertEqual(results[1][0], other)
+        self.assertEqual(results[1][1], (True, False, f'{other} does not have a DOI'))
+
+        document = ElementTree.fromstring(out.getvalue())
+        deposits = document.findall("deposit")
+        self.assertEqual([(d.get("pk"), d.get("doi"), d.get("target")) for d in deposits], [(str(self.preprint.pk), "10.9999/TEST", self.preprint.url)])
+        self.assertEqual(deposits[0][0].tag, "{http://www.crossref.org/schema/4.4.0}posted_content")
+
+        out = io.StringIO()
+        head = export.batch_head("batch_1", "Depositor", "depositor@test.edu", "Registrant")
+        results = list(export.write_batch(bulk.select_preprints(short_name=self.repo.short_name), prepare, out, "batch_1", head, chunk_size=1))
+        self.assertEqual([result for item, result in results], [None, (True, False, f'{other} does not have a DOI')])
+        batch = ElementTree.fromstring(out.getvalue())
+        crossref = "{http://www.crossref.org/schema/4.4.0}"
+        self.assertEqual((batch.tag, batch.get("version")), (crossref + "doi_batch", "4.4.0"))
+        self.assertEqual([child.tag for child in batch], [crossref + "head", crossref + "body"])
+        self.assertEqual(batch.find(f"{crossref}head/{crossref}doi_batch_id").text, "batch_1")
+        self.assertEqual([child.tag for child in batch.find(crossref + "body")], [crossref + "posted_content"])
+        doi_data = batch.find(f"{crossref}body/{crossref}posted_content/{crossref}doi_data")
+        self.assertEqual((doi_data.find(crossref + "doi").text, doi_data.find(crossref + "resource").text), ("10.9999/TEST", self.preprint.url))
+
+class EZIDTransportTest(SimpleTestCase):
+    def setUp(self):
+        self.clients = set()
+        self.auth_headers = []
+        self.paths = []
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                test.clients.add(self.client_address)
+                test.auth_headers.append(self.headers.get('Authorization'))
+                test.paths.append(self.path)
+                self.rfile.read(int(self.headers['Content-Length']))
+                if self.path.startswith('/shoulder/slow'):
+                    # outlasts the client's timeout, the client has gone by the time the response is written
+                    time.sleep(1)
+                    self.close_connection = True
+                    return
+                code, body = (201, b"success: doi:10.9999/TEST | ark:/b9999/test") if self.path.startswith('/shoulder') else (400, b"error: bad request")
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        transport.close_transports()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            result = logic.send_request("POST", "shoulder/shoulder", "crossref: test", "username", "password", self.endpoint_url)
+            self.assertEqual(result, "success: doi:10.9999/TEST | ark:/b9999/test")
+        self.assertEqual(len(self.clients), 1)
+
+    def test_timeout_on_reused_connection_not_resent(self):
+        ezid_transport = transport.get_transport(self.endpoint_url)
+        with mock.patch.object(transport, 'HTTP_TIMEOUT', 0.2):
+            ezid_transport.request("POST", "shoulder/shoulder", "crossref: test", "username", "password")
+            with self.assertRaises(URLError):
+                ezid_transport.request("POST", "shoulder/slow", "crossref: test", "username", "password")
+        # give the server the time to take a resent request
+        time.sleep(1.5)
+        self.assertEqual(self.paths, ["/shoulder/shoulder", "/shoulder/slow"])
+
+    def test_async_timeout_on_reused_connection_not_resent(self):
+        async def send_twice():
+            client = async_bulk.AsyncEzidClient(self.endpoint_url)
+            try:
+                await client.request("POST", "shoulder/shoulder", "crossref: test", "username", "password")
+                with self.assertRaises(URLError):
+                    await client.request("POST", "shoulder/slow", "crossref: test", "username", "password")
+            finally:
+                await client.close()
+        with mock.patch.object(async_bulk, 'HTTP_TIMEOUT', 0.2):
+            asyncio.run(send_twice())
+        time.sleep(1.5)
+        self.assertEqual(self.paths, ["/shoulder/shoulder", "/shoulder/slow"])
+
+    def test_preemptive_auth(self):
+        logic.send_request("POST", "shoulder/shoulder", "crossref: test", "username", "password", self.endpoint_url)
+        self.assertEqual(self.auth_headers, ["Basic dXNlcm5hbWU6cGFzc3dvcmQ="])
+
+    def test_error_response(self):
+        result = logic.send_request("POST", "id/doi:10.9999/TEST", "crossref: test", "username", "password", self.endpoint_url)
+        self.assertEqual(result, "error: bad request\n")
+
+    def test_async_responses_match_sync(self):
+        async def send_all():
+            client = async_bulk.AsyncEzidClient(self.endpoint_url)
+            try:
+                return [await async_bulk.send_request_async(client, "POST", path, "crossref: test", "username", "password")
+                        for path in ["shoulder/shoulder", "shoulder/shoulder", "id/doi:10.9999/TEST"]]
+            finally:
+                await client.close()
+        self.assertEqual(asyncio.run(send_all()), [
+            "success: doi:10.9999/TEST | ark:/b9999/test",
+            "success: doi:10.9999/TEST | ark:/b9999/test",
+            "error: bad request\n",
+        ])
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.auth_headers[0], "Basic dXNlcm5hbWU6cGFzc3dvcmQ=")
+
+    def test_run_async_deposits(self):
+        items = [mock.Mock(pk=pk) for pk in range(1, 6)]
+        def prepare(item):
+            if item.pk == 3:
+                return False, False, "EZID not enabled"
+            return logic.Deposit(item, "mint", "POST", "shoulder/shoulder", "crossref: test", "", "username", "password", self.endpoint_url)
+        progress = bulk.Progress()
+        with mock.patch.object(logic, 'complete_deposit', side_effect=lambda deposit, ezid_result, latency=None: (True, True, ezid_result)) as mock_complete:
+            results = list(async_bulk.run_async_deposits(items, prepare, workers=1, progress=progress, chunk_size=2))
+        self.assertEqual(sorted(r.item.pk for r in results), [1, 2, 3, 4, 5])
+        self.assertEqual(mock_complete.call_count, 4)
+        self.assertFalse(next(r for r in results if r.item.pk == 3).enabled)
+        self.assertEqual(progress.resume_after, 5)
+        self.assertEqual(len(self.clients), 1)
+
+class EZIDBulkTest(SimpleTestCase):
+    def test_run_deposits(self):
+        def deposit(item):
+            if item == 3:
+                raise ValueError("boom")
+            return True, item % 2 == 0, f"item {item}"
+
+        results = sorted(bulk.run_deposits(range(10), deposit, workers=3), key=lambda r: r.item)
+
+        self.assertEqual([r.item for r in results], list(range(10)))
+        self.assertEqual([r.success for r in results], [i % 2 == 0 and i != 3 for i in range(10)])
+        self.assertEqual(results[3], bulk.DepositResult(3, True, False, "boom"))
+
+    def test_progress(self):
+        progress = bulk.Progress()
+        for pk in [1, 2, 5, 8]:
+            progress.submit(pk)
+        self.assertIsNone(progress.resume_after)
+        progress.done(2)
+        self.assertIsNone(progress.resume_after)
+        progress.done(1)
+        self.assertEqual(progress.resume_after, 2)
+        progress.done(8)
+        self.assertEqual(progress.resume_after, 2)
+        progress.done(5)
+        self.assertEqual(progress.resume_after, 8)
+
+    def test_prometheus_sink(self):
+        sink = metrics.PrometheusSink()
+        sink.observe(metrics.SPAN_SECONDS, 0.02, span="send_request")
+        sink.observe(metrics.SPAN_SECONDS, 3, span="send_request")
+        sink.increment(metrics.DEPOSITS_TOTAL, action="update", outcome="failure")
+        text = sink.render()
+        self.assertIn('# TYPE ezid_span_seconds histogram\n', text)
+        self.assertIn('ezid_span_seconds_bucket{span="send_request",le="0.025"} 1\n', text)
+        self.assertIn('ezid_span_seconds_bucket{span="send_request",le="+Inf"} 2\n', text)
+        self.assertIn('ezid_span_seconds_count{span="send_request"} 2\n', text)
+        self.assertIn('ezid_deposits_total{action="update",outcome="failure"} 1\n', text)
+
+    def test_metrics_disabled(self):
+        calls = []
+        timed = metrics.timed('test')(lambda: calls.append(1))
+        with mock.patch.object(metrics, '_sink', None):
+            timed()
+        self.assertEqual(calls, [1])
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(rate=50)
+        waited = sum(bucket.acquire() for _ in range(6))
+        self.assertGreater(waited, 0.05)
+        self.assertEqual(bucket.acquired, 6)
+        self.assertAlmostEqual(bucket.waited, waited)
+
+    def test_shared_token_bucket(self):
+        cache.clear()
+        bucket = ratelimit.SharedTokenBucket(rate=2, key="https://ezid.test username")
+        # another process limiting the same account
+        other = ratelimit.SharedTokenBucket(rate=2, key="https://ezid.test username")
+        with mock.patch.object(ratelimit, 'time') as clock:
+            clock.time.side_effect = [1000.0, 1000.25, 1000.75, 1000.75, 1001.25]
+            self.assertEqual(bucket.acquire(), 0)
+            # half a token has been refilled, the other half takes 0.25s
+            self.assertEqual(bucket.acquire(), 0.25)
+            self.assertEqual(other.acquire(), 0.5)
+            self.assertEqual(clock.sleep.call_args_list, [mock.call(0.25), mock.call(0.5)])
+        self.assertEqual((bucket.acquired, other.acquired), (2, 1))
+
+    def test_shared_token_bucket_lock(self):
+        cache.clear()
+        bucket = ratelimit.SharedTokenBucket(rate=2, key="https://ezid.test username")
+        cache.set(bucket.lock_key, "other process")
+        with mock.patch.object(ratelimit, 'time') as clock:
+            clock.time.return_value = 1000.0
+            # the other process releases its lock while this one backs off
+            clock.sleep.side_effect = lambda delay: cache.delete(bucket.lock_key)
+            self.assertEqual(bucket.acquire(), 0)
+            self.assertLessEqual(clock.sleep.call_args[0][0], ratelimit.LOCK_BACKOFF)
+        self.assertIsNone(cache.get(bucket.lock_key))
+
+        # a lock that expired and was taken by another process is left alone
+        cache.set(bucket.lock_key, "other process")
+        bucket._unlock_bucket("expired")
+        self.assertEqual(cache.get(bucket.lock_key), "other process")
+
+    def test_limiter_per_account(self):
+        self.addCleanup(ratelimit.configure, ratelimit._max_rps, ratelimit._shared)
+        ratelimit.configure(10, shared=False)
+        limiter = ratelimit.get_limiter("https://ezid.test", "username")
+        self.assertIs(limiter, ratelimit.get_limiter("https://ezid.test", "username"))
+        self.assertIsNot(limiter, ratelimit.get_limiter("https://ezid.test", "other"))
+        ratelimit.configure(None)
+        self.assertIsNone(ratelimit.get_limiter("https://ezid.test", "username"))
+
+class EZIDResilienceTest(SimpleTestCase):
+    def setUp(self):
+        self.policy = resilience.RetryPolicy(attempts=4, backoff=0.001, max_backoff=0.001, deadline=5)
+        self.breaker = resilience.CircuitBreaker(threshold=3, reset=60)
+
+    def test_retry_server_error(self):
+        responses = [transport.EzidResponse("error: unavailable\n", 503), transport.EzidResponse("success: doi:10.9999/TEST", 201)]
+        result = resilience.call(lambda: responses.pop(0), self.breaker, policy=self.policy)
+        self.assertEqual(result, "success: doi:10.9999/TEST")
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_no_retry_client_error(self):
+        func = mock.Mock(return_value=transport.EzidResponse("error: bad request\n", 400))
+        result = resilience.call(func, self.breaker, policy=self.policy)
+        self.assertEqual(result, "error: bad request\n")
+        func.assert_called_once()
+
+    def test_no_retry_ambiguous_mint(self):
+        func = mock.Mock(return_value=transport.EzidResponse("error: internal server error\n", 500))
+        resilience.call(func, self.breaker, idempotent=False, policy=self.policy)
+        func.assert_called_once()
+
+    def test_network_error_retried_then_raised(self):
+        func = mock.Mock(side_effect=ConnectionResetError())
+        breaker = resilience.CircuitBreaker(threshold=10)
+        with self.assertRaises(ConnectionResetError):
+            resilience.call(func, breaker, policy=self.policy)
+        self.assertEqual(func.call_count, 4)
+
+    def test_breaker_opens(self):
+        func = mock.Mock(return_value=transport.EzidResponse("error: unavailable\n", 503))
+        resilience.call(func, self.breaker, policy=self.policy)
+        self.assertTrue(self.breaker.is_open)
+        self.assertEqual(func.call_count, 3)
+        with self.assertRaises(resilience.CircuitOpenError):
+            resilience.call(func, self.breaker, policy=self.policy)
+        self.assertEqual(func.call_count, 3)
+
+    def test_breaker_trial_raises(self):
+        self.breaker.failures, self.breaker.opened_at = 3, time.monotonic() - 61
+        with self.assertRaises(ValueError):
+            resilience.call(mock.Mock(side_effect=ValueError()), self.breaker, policy=self.policy)
+        self.assertTrue(self.breaker.is_open)
+        with self.assertRaises(resilience.CircuitOpenError):
+            resilience.call(mock.Mock(), self.breaker, policy=self.policy)
+        self.breaker.opened_at -= 61
+        func = mock.Mock(return_value=transport.EzidResponse("success: doi:10.9999/TEST", 201))
+        resilience.call(func, self.breaker, policy=self.policy)
+        func.assert_called_once()
+        self.assertFalse(self.breaker.is_open)
+
+    @mock.patch.object(resilience, 'call', side_effect=URLError('connection refused'))
+    def test_send_request_network_error(self, mock_call):
+        result = logic.send_request("POST", "id/doi:10.9999/TEST", "crossref: test", "username", "password", "https://ezid.test")
+        self.assertEqual(result, "error: <urlopen error connection refused>\n")
+
+class EZIDBenchmarkTest(SimpleTestCase):
+    def tearDown(self):
+        transport.close_transports()
+
+    def test_fake_ezid_server(self):
+        with FakeEzidServer(challenge=True) as server:
+            minted = [logic.send_request("POST", "shoulder/doi:10.5072/FK2", "crossref: test", "username", "password", server.url) for _ in range(2)]
+            updated = logic.send_request("POST", "id/doi:10.5072/FK2FAKE1", "crossref: test", "username", "password", server.url)
+            refused = logic.send_request("POST", "id/doi:10.5072/FK2FAKE1", "crossref: test", "username", "wrong", server.url)
+        self.assertEqual(minted, ["success: doi:10.5072/FK2FAKE1 | ark:/b5072/fake1", "success: doi:10.5072/FK2FAKE2 | ark:/b5072/fake2"])
+        self.assertEqual(updated, "success: doi:10.5072/FK2FAKE1")
+        self.assertEqual(updated.status, 200)
+        self.assertEqual(refused, "error: unauthorized\n")
+        self.assertEqual(server.statuses, {201: 2, 200: 1, 401: 1})
+
+    def test_fake_ezid_server_errors(self):
+        with FakeEzidServer(error_rate=1) as server:
+            self.assertEqual(server.respond("POST", "/shoulder/doi:10.5072/FK2", None), (503, "error: service unavailable"))
+        with FakeEzidServer(reject_rate=1) as server:
+            self.assertEqual(server.respond("POST", "/shoulder/doi:10.5072/FK2", None)[0], 400)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark_ezid.percentile(values, 0.5), 50)
+        self.assertEqual(benchmark_ezid.percentile(values, 0.99), 99)
+        self.assertEqual(benchmark_ezid.percentile([3], 0.99), 3)
+        self.assertIsNone(benchmark_ezid.percentile([], 0.5))
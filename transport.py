@@ -0,0 +1,211 @@
+"""
+HTTP transport for the EZID plugin for Janeway.
+
+urllib closes the socket after every request, so each deposit used to pay for
+a TCP/TLS handshake plus a 401 challenge before the credentials were sent.
+The transport below keeps a pool of keep-alive connections per EZID endpoint
+and sends Basic credentials with the first request.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import base64
+import http.client
+import io
+import select
+import threading
+import urllib.request as urlreq
+import urllib.response
+from urllib.error import URLError
+
+from django.conf import settings
+
+# idle connections kept per endpoint, enough for the bulk worker pools
+MAX_IDLE_CONNECTIONS = 16
+# seconds to wait on a connect or read before giving up on an attempt
+HTTP_TIMEOUT = getattr(settings, 'EZID_HTTP_TIMEOUT', 30)
+
+
+class EzidResponse(str):
+    ''' the text of an EZID response, carrying the HTTP status it came with '''
+    def __new__(cls, text, status):
+        response = super().__new__(cls, text)
+        response.status = status
+        return response
+
+
+class EzidHTTPErrorProcessor(urlreq.HTTPErrorProcessor):
+    ''' Error Processor, required to let 201 responses pass '''
+    def http_response(self, request, response):
+        if response.code == 201:
+            my_return = response
+        else:
+            my_return = urlreq.HTTPErrorProcessor.http_response(self, request, response)
+        return my_return
+    https_response = http_response
+
+
+def is_dropped(connection):
+    ''' whether the server has closed an idle connection, which then has the end of file waiting to be read '''
+    if connection.sock is None:
+        return True
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class ConnectionPool:
+    ''' thread safe pool of idle http.client connections keyed by (http_class, host) '''
+    def __init__(self, maxsize=MAX_IDLE_CONNECTIONS):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        while True:
+            with self._lock:
+                connections = self._idle.get(key)
+                if not connections:
+                    return None
+                connection = connections.pop()
+            if not is_dropped(connection):
+                return connection
+            connection.close()
+
+    def release(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class KeepAliveHandler(urlreq.HTTPHandler, urlreq.HTTPSHandler):
+    ''' urllib handler that reuses pooled connections instead of closing them '''
+    def __init__(self, pool):
+        urlreq.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._open(http.client.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self._open(http.client.HTTPSConnection, req, context=self._context)
+
+    def _open(self, http_class, req, **http_conn_args):
+        if not req.host:
+            raise URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers["Connection"] = "keep-alive"
+        headers = {name.title(): val for name, val in headers.items()}
+
+        key = (http_class, req.host)
+        connection = self.pool.acquire(key)
+        reused = connection is not None
+        if not reused:
+            connection = http_class(req.host, timeout=req.timeout, **http_conn_args)
+
+        try:
+            connection.request(req.get_method(), req.selector, req.data, headers)
+        except (BrokenPipeError, ConnectionResetError) as err:
+            connection.close()
+            if reused:
+                # the server had already dropped the idle keep-alive connection, so the request never reached it
+                return self._open(http_class, req, **http_conn_args)
+            raise URLError(err)
+        except (OSError, http.client.HTTPException) as err:
+            connection.close()
+            raise URLError(err)
+
+        try:
+            response = connection.getresponse()
+            body = response.read()
+        except http.client.RemoteDisconnected as err:
+            connection.close()
+            if reused and getattr(req, 'idempotent', False):
+                # closed before the first byte of a response, most likely the server timing out the idle connection;
+                # only safe to send again when doing so twice has the same effect as once
+                return self._open(http_class, req, **http_conn_args)
+            raise URLError(err)
+        except (OSError, http.client.HTTPException) as err:
+            # a timeout or a partial response, the request may have been acted on
+            connection.close()
+            raise URLError(err)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.release(key, connection)
+
+        # the body has been read in full so the connection can go back to the pool
+        result = urllib.response.addinfourl(io.BytesIO(body), response.msg, req.get_full_url(), response.status)
+        result.msg = response.reason
+        return result
+
+
+class EzidTransport:
+    ''' reusable opener and connection pool for a single EZID endpoint '''
+    def __init__(self, endpoint_url):
+        self.endpoint_url = endpoint_url
+        self.pool = ConnectionPool()
+        self.opener = urlreq.build_opener(EzidHTTPErrorProcessor(), KeepAliveHandler(self.pool))
+
+    def request(self, method, path, data, username, password, idempotent=False):
+        request = urlreq.Request(f"{self.endpoint_url}/{path}")
+        request.get_method = lambda: method
+        # lets KeepAliveHandler resend it when a reused connection turns out to be closed
+        request.idempotent = idempotent
+        request.add_header("Content-Type", "text/plain; charset=UTF-8")
+        # send the credentials up front rather than waiting for the 401 challenge
+        credentials = base64.b64encode(f"{username}:{password}".encode("UTF-8")).decode("ascii")
+        request.add_unredirected_header("Authorization", f"Basic {credentials}")
+        request.data = data.encode("UTF-8") if data is not None else None
+
+        try:
+            connection = self.opener.open(request, timeout=HTTP_TIMEOUT)
+            response = connection.read()
+            return EzidResponse(response.decode("UTF-8"), connection.code)
+
+        except urlreq.HTTPError as ezid_error:
+            if ezid_error.fp is not None:
+                response = ezid_error.fp.read().decode("utf-8")
+                if not response.endswith("\n"):
+                    response += "\n"
+            return EzidResponse(response, ezid_error.code)
+
+    def close(self):
+        self.pool.close()
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+def get_transport(endpoint_url):
+    ''' returns the shared transport for endpoint_url, creating it on first use '''
+    with _transports_lock:
+        transport = _transports.get(endpoint_url)
+        if transport is None:
+            transport = _transports[endpoint_url] = EzidTransport(endpoint_url)
+        return transport
+
+def close_transports():
+    ''' closes every pooled connection, e.g. at the end of a bulk run '''
+    with _transports_lock:
+        transports = list(_transports.values())
+        _transports.clear()
+    for transport in transports:
+        transport.close()
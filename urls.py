@@ -5,4 +5,5 @@ from plugins.ezid import views
 
 urlpatterns = [
     re_path(r'^manager/$', views.ezid_manager, name='ezid_manager'),
+    re_path(r'^metrics/$', views.ezid_metrics, name='ezid_metrics'),
 ]
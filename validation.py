@@ -0,0 +1,98 @@
+"""
+Offline validation of rendered EZID deposits against the Crossref schemas, for the EZID plugin for Janeway
+
+The schema version is taken from the namespace of the rendered XML (5.3.1 for the journal templates, 4.4.0 for
+posted_content.xml) and crossref<version>.xsd, with the schemas it imports, is loaded from EZID_SCHEMA_DIR. Each
+schema is parsed once per process. Schema validation needs lxml; without it, or without the schema files, payloads
+are only checked to be well formed XML.
+"""
+
+__copyright__ = "Copyright (c) 2020, The Regents of the University of California"
+__author__ = "Hardy Pottinger, Mahjabeen Yucekul & Esther Verreau"
+__license__ = "BSD 3-Clause"
+__maintainer__ = "California Digital Library"
+
+import os
+import re
+import threading
+from functools import lru_cache
+from xml.etree import ElementTree
+
+from django.conf import settings
+from utils.logger import get_logger
+
+from plugins.ezid import bulk, logic, reconcile
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+logger = get_logger(__name__)
+
+SCHEMA_DIR = getattr(settings, 'EZID_SCHEMA_DIR', os.path.join(os.path.dirname(__file__), 'schemas'))
+
+_RE_SCHEMA_VERSION = re.compile(r'xmlns="http://www\.crossref\.org/schema/([0-9.]+)"')
+# an lxml schema keeps the errors of its last validation on itself
+_schema_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def get_schema(version):
+    ''' the parsed Crossref schema for version, or None when lxml or the schema file is not available '''
+    path = os.path.join(SCHEMA_DIR, f'crossref{version}.xsd')
+    if etree is None:
+        logger.warning('lxml is not installed, EZID payloads are only checked to be well formed')
+        return None
+    if not os.path.exists(path):
+        logger.warning(f'{path} not found, EZID payloads for Crossref {version} are only checked to be well formed')
+        return None
+    return etree.XMLSchema(etree.parse(path))
+
+# the message of a deposit that is well formed but could not be checked against a schema
+WELL_FORMED_ONLY = "well formed, no schema loaded"
+
+def payload_schema(payload):
+    ''' the schema the Crossref XML in a prepare_payload result is validated against, None when there is none '''
+    match = _RE_SCHEMA_VERSION.search(reconcile.parse_anvl(payload).get("crossref", ""))
+    return get_schema(match.group(1)) if match else None
+
+def validate_payload(payload):
+    ''' returns the schema violations of the Crossref XML in a prepare_payload result, an empty list when it is valid '''
+    xml = reconcile.parse_anvl(payload).get("crossref", "").encode("UTF-8")
+    if etree is None:
+        try:
+            ElementTree.fromstring(xml)
+        except ElementTree.ParseError as e:
+            return [f"not well formed: {e}"]
+        return []
+
+    try:
+        document = etree.fromstring(xml)
+    except etree.XMLSyntaxError as e:
+        return [f"not well formed: {e}"]
+    schema = payload_schema(payload)
+    if schema is None:
+        return []
+    with _schema_lock:
+        if schema.validate(document):
+            return []
+        return [f"line {error.line}: {error.message}" for error in schema.error_log]
+
+def dry_run(items, prepare, chunk_size=bulk.CHUNK_SIZE):
+    ''' renders the deposit for every item without sending it and yields a DepositResult with its violations
+
+    prepare is logic.preprint_deposit or logic.journal_deposit with the action bound. Items prepare returns a result
+    for instead of a deposit are passed through as they are. The msg of a deposit that passes is "valid", or
+    WELL_FORMED_ONLY when no schema was loaded for it.
+    '''
+    for item in bulk.iterate(items, chunk_size):
+        deposit = prepare(item)
+        if not isinstance(deposit, logic.Deposit):
+            yield bulk.DepositResult(bulk.compact(item), *deposit)
+            continue
+        violations = validate_payload(deposit.payload)
+        if violations:
+            msg = "; ".join(violations)
+        else:
+            msg = "valid" if payload_schema(deposit.payload) is not None else WELL_FORMED_ONLY
+        yield bulk.DepositResult(bulk.compact(item), True, not violations, msg)
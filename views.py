@@ -1,14 +1,37 @@
+import hmac
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
 
-from plugins.ezid import forms
+from plugins.ezid import forms, metrics
+from plugins.ezid.models import QueuedDeposit
 
 
+@staff_member_required
 def ezid_manager(request):
     form = forms.DummyManagerForm()
+    deposits = QueuedDeposit.objects.select_related('content_type').order_by('-updated')[:50]
 
     template = 'ezid/manager.html'
     context = {
         'form': form,
+        'deposits': deposits,
     }
 
     return render(request, template, context)
+
+
+def ezid_metrics(request):
+    ''' this process's EZID metrics in the Prometheus text format, when EZID_METRICS is 'prometheus' '''
+    sink = metrics.get_sink()
+    if not isinstance(sink, metrics.PrometheusSink):
+        raise Http404
+
+    token = getattr(settings, 'EZID_METRICS_TOKEN', None)
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (request.user.is_staff or token and hmac.compare_digest(authorization, f'Bearer {token}')):
+        return HttpResponseForbidden()
+
+    return HttpResponse(sink.render(), content_type='text/plain; version=0.0.4; charset=utf-8')